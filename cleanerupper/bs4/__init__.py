@@ -25,7 +25,7 @@ __version__ = "4.6.0"
 __copyright__ = "Copyright (c) 2004-2017 Leonard Richardson"
 __license__ = "MIT"
 
-__all__ = ['BeautifulSoup']
+__all__ = ['BeautifulSoup', 'SoupFactory']
 
 import os
 import re
@@ -46,6 +46,7 @@ from .element import (
     ResultSet,
     SoupStrainer,
     Tag,
+    TagNameIndex,
     )
 
 # The very first thing we do is give a useful error if someone is
@@ -84,12 +85,35 @@ class BeautifulSoup(Tag):
 
     NO_PARSER_SPECIFIED_WARNING = "No parser was explicitly specified, so I'm using the best available %(markup_type)s parser for this system (\"%(parser)s\"). This usually isn't a problem, but if you run this code on another system, or in a different virtual environment, it may use a different parser and behave differently.\n\nThe code that caused this warning is on line %(line_number)s of the file %(filename)s. To get rid of this warning, change code that looks like this:\n\n BeautifulSoup(YOUR_MARKUP})\n\nto this:\n\n BeautifulSoup(YOUR_MARKUP, \"%(parser)s\")\n"
 
+    # Called with each top-level element as soon as it's been parsed.
+    # See __init__.
+    on_subtree = None
+
+    # Whether the tags in this soup hash and compare by identity. See
+    # __init__.
+    hash_by_identity = True
+
     def __init__(self, markup="", features=None, builder=None,
                  parse_only=None, from_encoding=None, exclude_encodings=None,
-                 **kwargs):
+                 on_subtree=None, hash_by_identity=True, **kwargs):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
-        is fed into the underlying parser."""
+        is fed into the underlying parser.
+
+        If `on_subtree` is given, every element that would end up at
+        the top level of the tree is taken out of it as soon as it's
+        complete--a tag once its end tag is seen--and passed to
+        on_subtree(element). Together with `parse_only`, this lets you
+        pull the parts you want out of a big document without ever
+        having the rest of it in memory. html5lib builds its tree its
+        own way and doesn't call on_subtree.
+
+        The tags in the soup hash and compare by identity, so a set or
+        a dict of tags never has to serialize them. If
+        `hash_by_identity` is False, two tags are equal if they have
+        the same markup, as structurally_equal() says, and hash
+        accordingly.
+        """
 
         if 'convertEntities' in kwargs:
             warnings.warn(
@@ -152,40 +176,55 @@ class BeautifulSoup(Tag):
                 "__init__() got an unexpected keyword argument '%s'" % arg)
 
         if builder is None:
-            original_features = features
-            if isinstance(features, str):
-                features = [features]
-            if features is None or len(features) == 0:
-                features = self.DEFAULT_BUILDER_FEATURES
-            builder_class = builder_registry.lookup(*features)
-            if builder_class is None:
-                raise FeatureNotFound(
-                    "Couldn't find a tree builder with the features you "
-                    "requested: %s. Do you need to install a parser library?"
-                    % ",".join(features))
-            builder = builder_class()
-            if not (original_features == builder.NAME or
-                    original_features in builder.ALTERNATE_NAMES):
-                if builder.is_xml:
-                    markup_type = "XML"
-                else:
-                    markup_type = "HTML"
-
-                caller = traceback.extract_stack()[0]
-                filename = caller[0]
-                line_number = caller[1]
-                warnings.warn(self.NO_PARSER_SPECIFIED_WARNING % dict(
-                    filename=filename,
-                    line_number=line_number,
-                    parser=builder.NAME,
-                    markup_type=markup_type))
-
+            builder = self._builder_for_features(features)
+
+        self.hash_by_identity = hash_by_identity
+        self._parse_markup(
+            markup, builder, parse_only, from_encoding, exclude_encodings,
+            on_subtree)
+
+    @classmethod
+    def _builder_for_features(cls, features):
+        """Instantiate the registered tree builder with these features."""
+        original_features = features
+        if isinstance(features, str):
+            features = [features]
+        if features is None or len(features) == 0:
+            features = cls.DEFAULT_BUILDER_FEATURES
+        builder_class = builder_registry.lookup(*features)
+        if builder_class is None:
+            raise FeatureNotFound(
+                "Couldn't find a tree builder with the features you "
+                "requested: %s. Do you need to install a parser library?"
+                % ",".join(features))
+        builder = builder_class()
+        if not (original_features == builder.NAME or
+                original_features in builder.ALTERNATE_NAMES):
+            if builder.is_xml:
+                markup_type = "XML"
+            else:
+                markup_type = "HTML"
+
+            caller = traceback.extract_stack()[0]
+            filename = caller[0]
+            line_number = caller[1]
+            warnings.warn(cls.NO_PARSER_SPECIFIED_WARNING % dict(
+                filename=filename,
+                line_number=line_number,
+                parser=builder.NAME,
+                markup_type=markup_type))
+        return builder
+
+    def _parse_markup(self, markup, builder, parse_only, from_encoding,
+                      exclude_encodings, on_subtree=None):
+        """Build this object's tree out of `markup`."""
         self.builder = builder
         self.is_xml = builder.is_xml
         self.known_xml = self.is_xml
         self.builder.soup = self
 
         self.parse_only = parse_only
+        self.on_subtree = on_subtree
 
         if hasattr(markup, 'read'):        # It's a file-type object.
             markup = markup.read()
@@ -234,10 +273,12 @@ class BeautifulSoup(Tag):
         # reference to this object.
         self.markup = None
         self.builder.soup = None
+        self.on_subtree = None
 
     def __copy__(self):
         copy = type(self)(
-            self.encode('utf-8'), builder=self.builder, from_encoding='utf-8'
+            self.encode('utf-8'), builder=self.builder, from_encoding='utf-8',
+            hash_by_identity=self.hash_by_identity
         )
 
         # Although we encoded the tree to UTF-8, that may not have
@@ -252,6 +293,11 @@ class BeautifulSoup(Tag):
         d = dict(self.__dict__)
         if 'builder' in d and not self.builder.picklable:
             d['builder'] = None
+        # The Tag attributes live in slots, not in __dict__.
+        d.update(self._attribute_values())
+        # The name index is keyed by id(), which doesn't survive
+        # pickling.
+        d['name_index'] = None
         return d
 
     @staticmethod
@@ -293,15 +339,60 @@ class BeautifulSoup(Tag):
             self.popTag()
 
     def reset(self):
+        self.name_index = None
+        self.mutation_version = 0
+        self.change_journal = None
         Tag.__init__(self, self, self.builder, self.ROOT_TAG_NAME)
         self.hidden = 1
         self.builder.reset()
         self.current_data = []
         self.currentTag = None
+        self._most_recent_element = None
         self.tagStack = []
         self.preserve_whitespace_tag_stack = []
         self.pushTag(self)
 
+    def start_name_index(self):
+        """Index every tag in the document by name.
+
+        While the index is active, find_all() with nothing but a tag
+        name is answered from the index instead of by walking the
+        tree. The index is kept current as tags are inserted, extracted,
+        decomposed or renamed, but not if you modify a tag's .contents
+        directly. Copies and pickles of the soup aren't indexed.
+        """
+        self.name_index = TagNameIndex(self)
+
+    def stop_name_index(self):
+        """Stop indexing tags by name."""
+        self.name_index = None
+
+    def start_change_journal(self):
+        """Start recording which parts of the document get changed.
+
+        From now on, every change to the tree adds an (element,
+        subtree) pair to the journal. If `subtree` is False, the
+        element's name, attributes or list of children changed. If
+        `subtree` is True, the element was put into the tree and
+        everything beneath it should be considered changed as well.
+
+        An element may show up in the journal more than once, and it
+        may have been removed from the tree since it was journaled.
+        """
+        self.change_journal = []
+
+    def pop_change_journal(self):
+        """Return the changes recorded so far and start a new journal."""
+        journal = self.change_journal or []
+        self.change_journal = []
+        return journal
+
+    def stop_change_journal(self):
+        """Stop recording changes and return the ones recorded so far."""
+        journal = self.change_journal or []
+        self.change_journal = None
+        return journal
+
     def new_tag(self, name, namespace=None, nsprefix=None, **attrs):
         """Create a new tag associated with this soup."""
         return Tag(None, self.builder, name, namespace, nsprefix, attrs)
@@ -323,8 +414,19 @@ class BeautifulSoup(Tag):
         #print "Pop", tag.name
         if self.tagStack:
             self.currentTag = self.tagStack[-1]
+        if self.on_subtree is not None and len(self.tagStack) == 1:
+            self._hand_over(tag)
         return self.currentTag
 
+    def _hand_over(self, element):
+        """Take a finished top-level element out of the tree and pass it
+        to on_subtree."""
+        previous = element.previous_element
+        element.extract()
+        # The next element parsed follows whatever came before this one.
+        self._most_recent_element = previous
+        self.on_subtree(element)
+
     def pushTag(self, tag):
         #print "Push", tag.name
         if self.currentTag:
@@ -363,6 +465,8 @@ class BeautifulSoup(Tag):
 
             o = containerClass(current_data)
             self.object_was_parsed(o)
+            if self.on_subtree is not None and len(self.tagStack) <= 1:
+                self._hand_over(o)
 
     def object_was_parsed(self, o, parent=None, most_recent_element=None):
         """Add an object to the parse tree."""
@@ -481,29 +585,91 @@ class BeautifulSoup(Tag):
 
     def decode(self, pretty_print=False,
                eventual_encoding=DEFAULT_OUTPUT_ENCODING,
-               formatter="minimal"):
+               formatter="minimal", sort_attributes=True):
         """Returns a string or Unicode representation of this document.
         To get Unicode, pass None for encoding."""
 
-        if self.is_xml:
-            # Print the XML declaration
-            encoding_part = ''
-            if eventual_encoding != None:
-                encoding_part = ' encoding="%s"' % eventual_encoding
-            prefix = '<?xml version="1.0"%s?>\n' % encoding_part
+        if not pretty_print:
+            indent_level = None
         else:
-            prefix = ''
+            indent_level = 0
+        return self._xml_declaration(eventual_encoding) + super(
+            BeautifulSoup, self).decode(
+                indent_level, eventual_encoding, formatter, sort_attributes)
+
+    def serialize(self, sink, pretty_print=False,
+                  eventual_encoding=DEFAULT_OUTPUT_ENCODING,
+                  formatter="minimal", sort_attributes=True):
+        """Write what decode() returns to `sink`, a list or a file-like
+        object, a piece at a time."""
         if not pretty_print:
             indent_level = None
         else:
             indent_level = 0
-        return prefix + super(BeautifulSoup, self).decode(
-            indent_level, eventual_encoding, formatter)
+        declaration = self._xml_declaration(eventual_encoding)
+        if declaration:
+            if isinstance(sink, list):
+                sink.append(declaration)
+            else:
+                sink.write(declaration)
+        super(BeautifulSoup, self).serialize(
+            sink, indent_level, eventual_encoding, formatter, sort_attributes)
+
+    def _xml_declaration(self, eventual_encoding):
+        if self.is_xml:
+            # Print the XML declaration
+            encoding_part = ''
+            if eventual_encoding != None:
+                encoding_part = ' encoding="%s"' % eventual_encoding
+            return '<?xml version="1.0"%s?>\n' % encoding_part
+        return ''
 
 # Alias to make it easier to type import: 'from bs4 import _soup'
 _s = BeautifulSoup
 _soup = BeautifulSoup
 
+class SoupFactory(object):
+    """Parse one document after another with the same tree builder.
+
+    BeautifulSoup(markup, features) looks up a tree builder and sets
+    it up all over again for every document. A SoupFactory does that
+    once, and its builder keeps what it can from one document to the
+    next, such as the HTMLParser object html.parser feeds the markup
+    to. The soups it makes all share the builder, as a soup and its
+    copy do.
+
+    A SoupFactory parses one document at a time, so don't share one
+    between threads.
+    """
+
+    def __init__(self, features=None, builder=None, parse_only=None,
+                 from_encoding=None, exclude_encodings=None,
+                 soup_class=BeautifulSoup, hash_by_identity=True):
+        if builder is None:
+            builder = soup_class._builder_for_features(features)
+        self.builder = builder
+        self.parse_only = parse_only
+        self.from_encoding = from_encoding
+        self.exclude_encodings = exclude_encodings
+        self.soup_class = soup_class
+        self.hash_by_identity = hash_by_identity
+
+    def parse(self, markup, on_subtree=None):
+        """Parse a document into a new soup_class object.
+
+        :param on_subtree: As for the BeautifulSoup constructor.
+        """
+        from_encoding = self.from_encoding
+        if isinstance(markup, str):
+            # Unicode markup is already decoded.
+            from_encoding = None
+        soup = self.soup_class.__new__(self.soup_class)
+        soup.hash_by_identity = self.hash_by_identity
+        soup._parse_markup(markup, self.builder, self.parse_only,
+                           from_encoding, self.exclude_encodings, on_subtree)
+        return soup
+
+
 class BeautifulStoneSoup(BeautifulSoup):
     """Deprecated interface to an XML parser."""
 
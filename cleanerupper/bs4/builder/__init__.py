@@ -2,9 +2,14 @@
 # found in the LICENSE file.
 
 from collections import defaultdict
+import hashlib
 import itertools
+import json
+import os
 import sys
+import time
 from bs4.element import (
+    AttributeValueList,
     CharsetMetaAttributeValue,
     ContentMetaAttributeValue,
     HTMLAwareEntitySubstitution,
@@ -32,6 +37,7 @@ class TreeBuilderRegistry(object):
     def __init__(self):
         self.builders_for_feature = defaultdict(list)
         self.builders = []
+        self.fastest_builders = {}
 
     def register(self, treebuilder_class):
         """Register a treebuilder based on its advertised features."""
@@ -77,6 +83,125 @@ class TreeBuilderRegistry(object):
                 return candidate
         return None
 
+    def fastest(self, probe, reference, features=(HTML,), cache_file=None,
+                repeat=5):
+        """Find the quickest builder that parses `probe` like `reference`.
+
+        Every registered builder with all of the given features parses
+        the probe document. The ones whose tree doesn't come out exactly
+        like the one the reference builder makes are ruled out, and of
+        the rest the one with the best time over `repeat` parses wins.
+
+        The answer is remembered for the rest of the process. If
+        `cache_file` is given, it's also written there, and later
+        processes read it instead of running the benchmark, until the
+        probe, the reference, the set of builders, the version of
+        Python or Beautiful Soup, or the source code of the builders or
+        of Beautiful Soup itself changes.
+
+        :param probe: A document like the ones you're going to parse.
+        :param reference: The name of the builder whose trees you want.
+        :return: A TreeBuilder subclass, or None if there's no builder
+            called `reference`.
+        """
+        reference_builder = self.lookup(reference)
+        if reference_builder is None:
+            return None
+        candidates = [
+            builder for builder in self.builders
+            if all(feature in builder.features for feature in features)]
+        memo_key = (probe, reference_builder, tuple(candidates))
+        if memo_key in self.fastest_builders:
+            return self.fastest_builders[memo_key]
+
+        key = self._calibration_key(probe, reference_builder, candidates)
+        chosen = None
+        if cache_file is not None:
+            try:
+                with open(cache_file, encoding="utf8") as fh:
+                    cached = json.load(fh)
+                if cached.get("key") == key:
+                    for builder in candidates:
+                        if builder.NAME == cached.get("builder"):
+                            chosen = builder
+            except (OSError, ValueError, AttributeError):
+                pass
+
+        if chosen is None:
+            chosen = self._calibrate(
+                probe, reference_builder, candidates, repeat)
+            if cache_file is not None:
+                temp = cache_file + ".tmp"
+                try:
+                    with open(temp, "w", encoding="utf8") as fh:
+                        json.dump(dict(key=key, builder=chosen.NAME), fh)
+                    os.replace(temp, cache_file)
+                except OSError:
+                    pass
+        self.fastest_builders[memo_key] = chosen
+        return chosen
+
+    def _calibration_key(self, probe, reference_builder, candidates):
+        """A digest of everything a calibration result depends on."""
+        from bs4 import __version__
+        hasher = hashlib.sha256()
+        for part in ([__version__, sys.version, probe, reference_builder.NAME]
+                     + [builder.__module__ + "." + builder.__name__
+                        for builder in candidates]):
+            hasher.update(part.encode("utf8"))
+            hasher.update(b"\0")
+
+        # The source of the builders and of the tree they build can
+        # change without the version changing, so hash that as well.
+        modules = ["bs4", "bs4.element"]
+        for builder in [reference_builder] + list(candidates):
+            for cls in builder.__mro__:
+                if cls.__module__ not in modules:
+                    modules.append(cls.__module__)
+        for name in modules:
+            path = getattr(sys.modules.get(name), "__file__", None)
+            if path is None:
+                continue
+            hasher.update(name.encode("utf8"))
+            try:
+                with open(path, "rb") as fh:
+                    hasher.update(fh.read())
+            except OSError:
+                pass
+        return hasher.hexdigest()
+
+    def _calibrate(self, probe, reference_builder, candidates, repeat):
+        """Time each candidate that agrees with the reference builder."""
+        from bs4 import BeautifulSoup
+        expected = BeautifulSoup(probe, builder=reference_builder()).decode()
+        agreeing = []
+        for builder in candidates:
+            try:
+                if BeautifulSoup(probe, builder=builder()).decode() == expected:
+                    agreeing.append(builder)
+            except Exception:
+                # A builder that can't parse the probe document at all
+                # is no use either.
+                pass
+        if not agreeing:
+            return reference_builder
+
+        # The builders take turns, so that a moment when the machine
+        # is busy with something else slows them all down alike.
+        best = dict((builder, None) for builder in agreeing)
+        for i in range(repeat):
+            for builder in agreeing:
+                start = time.perf_counter()
+                BeautifulSoup(probe, builder=builder())
+                elapsed = time.perf_counter() - start
+                if best[builder] is None or elapsed < best[builder]:
+                    best[builder] = elapsed
+        chosen = agreeing[0]
+        for builder in agreeing:
+            if best[builder] < best[chosen]:
+                chosen = builder
+        return chosen
+
 # The BeautifulSoup class will take feature lists from developers and use them
 # to look up builders in this registry.
 builder_registry = TreeBuilderRegistry()
@@ -99,11 +224,32 @@ class TreeBuilder(object):
     cdata_list_attributes = {}
 
 
+    # Strings this builder has already handed out for the current
+    # document. See intern().
+    interned_strings = None
+
     def __init__(self):
         self.soup = None
 
     def reset(self):
-        pass
+        self.interned_strings = {}
+
+    def intern(self, string):
+        """Return the first copy of this string that was seen while
+        building the current document.
+
+        Tag names, attribute names and class names repeat all through a
+        document, and the parsers make a new string for each one, so
+        the tree builders pass them through here to share them.
+        Subclasses of str, such as NamespacedAttribute, are returned
+        unchanged.
+        """
+        if type(string) is not str:
+            return string
+        table = self.interned_strings
+        if table is None:
+            table = self.interned_strings = {}
+        return table.setdefault(string, string)
 
     def can_be_empty_element(self, tag_name):
         """Might a tag with this name be an empty-element tag?
@@ -152,6 +298,8 @@ class TreeBuilder(object):
     def _replace_cdata_list_attribute_values(self, tag_name, attrs):
         """Replaces class="foo bar" with class=["foo", "bar"]
 
+        The list is an AttributeValueList.
+
         Modifies its input in place.
         """
         if not attrs:
@@ -167,7 +315,8 @@ class TreeBuilder(object):
                     # values. Split it into a list.
                     value = attrs[attr]
                     if isinstance(value, str):
-                        values = whitespace_re.split(value)
+                        values = AttributeValueList(
+                            map(self.intern, whitespace_re.split(value)))
                     else:
                         # html5lib sometimes calls setAttributes twice
                         # for the same tag when rearranging the parse
@@ -316,7 +465,10 @@ class ParserRejectedMarkup(Exception):
 # Builders are registered in reverse order of priority, so that custom
 # builder registrations will take precedence. In general, we want lxml
 # to take precedence over html5lib, because it's faster. And we only
-# want to use HTMLParser as a last result.
+# want to use HTMLParser as a last result. The XHTML tokenizer goes in
+# even before that, so it's only used when it's asked for by name.
+from . import _xhtml
+register_treebuilders_from(_xhtml)
 from . import _htmlparser
 register_treebuilders_from(_htmlparser)
 try:
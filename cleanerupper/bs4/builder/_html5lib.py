@@ -14,6 +14,7 @@ from bs4.builder import (
     HTMLTreeBuilder,
     )
 from bs4.element import (
+    AttributeValueList,
     NamespacedAttribute,
     whitespace_re,
 )
@@ -118,7 +119,7 @@ class TreeBuilderForHtml5lib(treebuilder_base.TreeBuilder):
         self.soup.object_was_parsed(doctype)
 
     def elementClass(self, name, namespace):
-        tag = self.soup.new_tag(name, namespace)
+        tag = self.soup.new_tag(self.soup.builder.intern(name), namespace)
         return Element(tag, self.soup, namespace)
 
     def commentClass(self, data):
@@ -206,7 +207,7 @@ class AttrList(object):
             # A node that is being cloned may have already undergone
             # this procedure.
             if not isinstance(value, list):
-                value = whitespace_re.split(value)
+                value = AttributeValueList(whitespace_re.split(value))
         self.element[name] = value
     def items(self):
         return list(self.attrs.items())
@@ -297,10 +298,11 @@ class Element(treebuilder_base.Node):
                     del attributes[name]
                     attributes[new_name] = value
 
-            self.soup.builder._replace_cdata_list_attribute_values(
+            builder = self.soup.builder
+            builder._replace_cdata_list_attribute_values(
                 self.name, attributes)
             for name, value in list(attributes.items()):
-                self.element[name] = value
+                self.element[builder.intern(name)] = value
 
             # The attributes may contain variables that need substitution.
             # Call set_up_substitutions manually.
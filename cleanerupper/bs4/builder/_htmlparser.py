@@ -78,16 +78,17 @@ class BeautifulSoupHTMLParser(HTMLParser):
         
     def handle_starttag(self, name, attrs, handle_empty_element=True):
         # XXX namespace
+        intern = self.soup.builder.intern
         attr_dict = {}
         for key, value in attrs:
             # Change None attribute values to the empty string
             # for consistency with the other tree builders.
             if value is None:
                 value = ''
-            attr_dict[key] = value
+            attr_dict[intern(key)] = value
             attrvalue = '""'
         #print "START", name
-        tag = self.soup.handle_starttag(name, None, None, attr_dict)
+        tag = self.soup.handle_starttag(intern(name), None, None, attr_dict)
         if tag and tag.is_empty_element and handle_empty_element:
             # Unlike other parsers, html.parser doesn't send separate end tag
             # events for empty-element tags. (It's handled in
@@ -182,6 +183,9 @@ class HTMLParserTreeBuilder(HTMLTreeBuilder):
     NAME = HTMLPARSER
     features = [NAME, HTML, STRICT]
 
+    # The BeautifulSoupHTMLParser this builder feeds documents to.
+    html_parser = None
+
     def __init__(self, *args, **kwargs):
         if CONSTRUCTOR_TAKES_STRICT and not CONSTRUCTOR_STRICT_IS_DEPRECATED:
             kwargs['strict'] = False
@@ -207,10 +211,34 @@ class HTMLParserTreeBuilder(HTMLTreeBuilder):
                dammit.declared_html_encoding,
                dammit.contains_replacement_characters)
 
-    def feed(self, markup):
-        args, kwargs = self.parser_args
-        parser = BeautifulSoupHTMLParser(*args, **kwargs)
+    def __getstate__(self):
+        # The parser is made again the next time it's needed.
+        d = dict(self.__dict__)
+        d.pop('html_parser', None)
+        return d
+
+    def parser_for_document(self):
+        """Return a BeautifulSoupHTMLParser ready for a new document.
+
+        The parser is made the first time, and reset and reused for
+        every document after that.
+        """
+        parser = self.html_parser
+        if parser is None:
+            args, kwargs = self.parser_args
+            parser = self.html_parser = BeautifulSoupHTMLParser(
+                *args, **kwargs)
+        else:
+            parser.reset()
+            parser.already_closed_empty_element = []
         parser.soup = self.soup
+        return parser
+
+    def feed(self, markup):
+        self.feed_parser(self.parser_for_document(), markup)
+
+    def feed_parser(self, parser, markup):
+        """Feed markup to a parser from parser_for_document()."""
         try:
             parser.feed(markup)
         except HTMLParseError as e:
@@ -218,6 +246,7 @@ class HTMLParserTreeBuilder(HTMLTreeBuilder):
                 "Python's built-in HTMLParser cannot parse the given document. This is not a bug in Beautiful Soup. The best solution is to install an external parser (lxml or html5lib), and use Beautiful Soup with that parser. See http://www.crummy.com/software/BeautifulSoup/bs4/doc/#installing-a-parser for help."))
             raise e
         parser.already_closed_empty_element = []
+        parser.soup = None
 
 # Patch 3.2 versions of HTMLParser earlier than 3.2.3 to use some
 # 3.2.3 code. This ensures they don't treat markup like <p></p> as a
@@ -0,0 +1,139 @@
+"""Tokenize well-formed XHTML with a handful of regular expressions.
+
+As soon as the tokenizer finds something it isn't sure about, HTMLParser
+takes over, so the trees it builds are the ones html.parser would build.
+"""
+
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+__all__ = [
+    'XHTMLTreeBuilder',
+    ]
+
+from html import unescape
+import re
+
+from bs4.builder import (
+    HTML,
+    STRICT,
+    )
+from bs4.builder._htmlparser import (
+    BeautifulSoupHTMLParser,
+    HTMLParserTreeBuilder,
+    )
+
+XHTMLPARSER = 'xhtml.parser'
+
+# One token per match: a run of text, a start tag, an end tag, an
+# entity or character reference, a comment, a doctype or a processing
+# instruction. Names are limited to the characters HTMLParser reads
+# the same way whatever surrounds them, and attribute values must be
+# quoted.
+_token = re.compile(r"""
+   ([^<&]+)                                        # 1: text
+  |<([a-zA-Z][-.:a-zA-Z0-9_]*)                     # 2: start tag name
+    ((?:[ \t\n\r\f]+[a-zA-Z_:][-.:a-zA-Z0-9_]*     # 3: attributes
+        [ \t\n\r\f]*=[ \t\n\r\f]*
+        (?:"[^"]*"|'[^']*'))*)
+    [ \t\n\r\f]*(/?)>                              # 4: empty-element slash
+  |</([a-zA-Z][-.:a-zA-Z0-9_]*)[ \t\n\r\f]*>       # 5: end tag name
+  |&\#([0-9]+|[xX][0-9a-fA-F]+);                   # 6: character reference
+  |&([a-zA-Z][-.a-zA-Z0-9]*);                      # 7: entity reference
+  |<!--(.*?)--\s*>                                 # 8: comment
+  |<!([dD][oO][cC][tT][yY][pP][eE][^>]*)>          # 9: doctype
+  |<\?([^>]*)>                                     # 10: processing instruction
+""", re.VERBOSE | re.DOTALL)
+
+_attribute = re.compile(r"""
+  ([a-zA-Z_:][-.:a-zA-Z0-9_]*)[ \t\n\r\f]*=[ \t\n\r\f]*
+  (?:"([^"]*)"|'([^']*)')
+""", re.VERBOSE)
+
+# The contents of these tags are not parsed, just as in HTMLParser.
+_cdata_content_elements = BeautifulSoupHTMLParser.CDATA_CONTENT_ELEMENTS
+
+
+class XHTMLTreeBuilder(HTMLParserTreeBuilder):
+    """A fast tree builder for documents that are well-formed XHTML.
+
+    The markup is split up with regular expressions and the pieces are
+    passed straight to the same event handlers HTMLParserTreeBuilder
+    uses. The first time the tokenizer finds something it doesn't
+    handle--a bare ampersand, an unquoted attribute value, a CDATA
+    section--it hands the rest of the document to HTMLParser, which
+    carries on from there. The tokenizer stops between two pieces of
+    markup that HTMLParser would also split there, so HTMLParser sees
+    the rest of the document just as it would have if it had parsed
+    the whole thing.
+    """
+
+    NAME = XHTMLPARSER
+    ALTERNATE_NAMES = ['xhtml']
+    features = ALTERNATE_NAMES + [NAME, HTML, STRICT]
+
+    def feed(self, markup):
+        parser = self.parser_for_document()
+        end = self._tokenize(markup, parser)
+        self.feed_parser(parser, markup[end:])
+
+    def _tokenize(self, markup, parser):
+        """Send HTMLParser's events for as much of `markup` as the
+        tokenizer understands to `parser`.
+
+        :return: The position the tokenizer stopped at.
+        """
+        handle_data = parser.handle_data
+        handle_starttag = parser.handle_starttag
+        handle_endtag = parser.handle_endtag
+        match = _token.match
+        pos = 0
+        end = len(markup)
+        while pos < end:
+            m = match(markup, pos)
+            if m is None:
+                return pos
+            kind = m.lastindex
+            if kind == 1:
+                handle_data(m.group(1))
+            elif kind == 4:
+                name, attributes, empty = m.group(2, 3, 4)
+                name = name.lower()
+                close = None
+                if not empty and name in _cdata_content_elements:
+                    close = re.compile(
+                        r'</\s*%s\s*>' % name, re.I).search(markup, m.end())
+                    if close is None:
+                        return pos
+                attrs = []
+                if attributes:
+                    for attr_name, double, single in _attribute.findall(
+                            attributes):
+                        value = double or single
+                        if value:
+                            value = unescape(value)
+                        attrs.append((attr_name.lower(), value))
+                if empty:
+                    parser.handle_startendtag(name, attrs)
+                else:
+                    handle_starttag(name, attrs)
+                if close is not None:
+                    if close.start() > m.end():
+                        handle_data(markup[m.end():close.start()])
+                    handle_endtag(name)
+                    pos = close.end()
+                    continue
+            elif kind == 5:
+                handle_endtag(m.group(5).lower())
+            elif kind == 6:
+                parser.handle_charref(m.group(6))
+            elif kind == 7:
+                parser.handle_entityref(m.group(7))
+            elif kind == 8:
+                parser.handle_comment(m.group(8))
+            elif kind == 9:
+                parser.handle_decl(m.group(9))
+            else:
+                parser.handle_pi(m.group(10))
+            pos = m.end()
+        return pos
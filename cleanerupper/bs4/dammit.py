@@ -87,6 +87,12 @@ class EntitySubstitution(object):
 
     AMPERSAND_OR_BRACKET = re.compile("([<>&])")
 
+    # The ASCII characters substitute_html() turns into entities. Text
+    # that is all ASCII and contains none of these can be left alone.
+    ASCII_HTML_ENTITY_CHARACTERS = tuple(sorted(
+        character for character in CHARACTER_TO_HTML_ENTITY
+        if ord(character) < 128))
+
     @classmethod
     def _substitute_html_entity(cls, matchobj):
         entity = cls.CHARACTER_TO_HTML_ENTITY.get(matchobj.group(0))
@@ -149,9 +155,13 @@ class EntitySubstitution(object):
         :param make_quoted_attribute: If True, then the string will be
          quoted, as befits an attribute value.
         """
-        # Escape angle brackets and ampersands.
-        value = cls.AMPERSAND_OR_BRACKET.sub(
-            cls._substitute_xml_entity, value)
+        # Escape angle brackets and ampersands. Most strings have none,
+        # so look before doing any work. Three replace() calls are
+        # faster than AMPERSAND_OR_BRACKET.sub(), or a str.translate()
+        # table, for all but very long strings.
+        if '&' in value or '<' in value or '>' in value:
+            value = value.replace('&', '&amp;').replace(
+                '<', '&lt;').replace('>', '&gt;')
 
         if make_quoted_attribute:
             value = cls.quoted_attribute_value(value)
@@ -172,8 +182,9 @@ class EntitySubstitution(object):
         """
         # Escape angle brackets, and ampersands that aren't part of
         # entities.
-        value = cls.BARE_AMPERSAND_OR_BRACKET.sub(
-            cls._substitute_xml_entity, value)
+        if '&' in value or '<' in value or '>' in value:
+            value = cls.BARE_AMPERSAND_OR_BRACKET.sub(
+                cls._substitute_xml_entity, value)
 
         if make_quoted_attribute:
             value = cls.quoted_attribute_value(value)
@@ -191,6 +202,13 @@ class EntitySubstitution(object):
         character with "&eacute;" will make it more readable to some
         people.
         """
+        if s.isascii():
+            for character in cls.ASCII_HTML_ENTITY_CHARACTERS:
+                if character in s:
+                    break
+            else:
+                # There's nothing to substitute.
+                return s
         return cls.CHARACTER_TO_HTML_ENTITY_RE.sub(
             cls._substitute_html_entity, s)
 
@@ -8,7 +8,7 @@ import cProfile
 from io import StringIO
 from html.parser import HTMLParser
 import bs4
-from bs4 import BeautifulSoup, __version__
+from bs4 import BeautifulSoup, SoupFactory, __version__
 from bs4.builder import builder_registry
 
 import os
@@ -201,6 +201,34 @@ def benchmark_parsers(num_elements=100000):
     b = time.time()
     print("Raw html5lib parsed the markup in %.2fs." % (b-a))
 
+def benchmark_setup(num_documents=10000, parser="html.parser"):
+    """Measure the fixed cost of parsing a document.
+
+    A document with one tag in it is parsed over and over, first
+    with a new BeautifulSoup object each time and then through a
+    SoupFactory, which sets up the tree builder only once.
+    """
+    data = "<p>%s</p>" % rsentence()
+    print("Parsing a %d-byte document %d times with %s." % (
+        len(data), num_documents, parser))
+
+    a = time.time()
+    for i in range(num_documents):
+        BeautifulSoup(data, parser)
+    b = time.time()
+    factory = SoupFactory(parser)
+    for i in range(num_documents):
+        factory.parse(data)
+    c = time.time()
+
+    per_soup = (b-a) / num_documents
+    per_factory = (c-b) / num_documents
+    print("BeautifulSoup() took %.1f microseconds per document." % (
+        per_soup * 1000000))
+    print("SoupFactory.parse() took %.1f microseconds per document." % (
+        per_factory * 1000000))
+    return per_soup, per_factory
+
 def profile(num_elements=100000, parser="lxml"):
 
     filehandle = tempfile.NamedTemporaryFile()
@@ -215,5 +243,30 @@ def profile(num_elements=100000, parser="lxml"):
     stats.sort_stats("cumulative")
     stats.print_stats('_html5lib|bs4', 50)
 
+def memory_per_node(num_elements=100000, parser="html.parser"):
+    """Measure how much memory a parsed tree takes up per node.
+
+    The figure covers everything the parse allocated and the tree kept:
+    the Tag and NavigableString objects, their attribute dicts, contents
+    lists and the text itself.
+    """
+    import gc
+    import tracemalloc
+    data = rdoc(num_elements)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        soup = BeautifulSoup(data, parser)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    nodes = sum(1 for node in soup.descendants)
+    per_node = (after - before) / nodes
+    print("BS4+%s kept %d bytes for %d nodes: %.1f bytes per node." % (
+        parser, after - before, nodes, per_node))
+    return per_node
+
 if __name__ == '__main__':
     diagnose(sys.stdin.read())
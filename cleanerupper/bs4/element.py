@@ -2,7 +2,7 @@
 # found in the LICENSE file.
 __license__ = "MIT"
 
-import collections
+import functools
 import re
 import shlex
 import sys
@@ -86,6 +86,82 @@ class ContentMetaAttributeValue(AttributeValueWithCharsetSubstitution):
             return match.group(1) + encoding
         return self.CHARSET_RE.sub(rewrite, self.original_value)
 
+def _clears_caches(name):
+    """Wrap a list method so that it also forgets what
+    AttributeValueList has worked out about the old values."""
+    method = getattr(list, name)
+    def wrapper(self, *args):
+        self._value_set = None
+        self._joined = None
+        return method(self, *args)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class AttributeValueList(list):
+    """The value of a multi-valued attribute such as 'class'.
+
+    This is still a list of the whitespace-separated values in source
+    order, so it can be changed like any other list, but membership
+    tests use a set that is built on demand, and the string that goes
+    into the markup is joined once and then reused until the list
+    changes. The tree builders intern the values (see
+    TreeBuilder.intern), so equal values in a document share a string.
+    """
+
+    __slots__ = ('_value_set', '_joined')
+
+    def __init__(self, values=()):
+        list.__init__(self, values)
+        self._value_set = None
+        self._joined = None
+
+    def __contains__(self, value):
+        if self._value_set is None:
+            try:
+                self._value_set = frozenset(self)
+            except TypeError:
+                return list.__contains__(self, value)
+        try:
+            return value in self._value_set
+        except TypeError:
+            return list.__contains__(self, value)
+
+    def __reduce_ex__(self, protocol):
+        return (type(self), (list(self),))
+
+    @property
+    def value_set(self):
+        """A frozenset of the values."""
+        if self._value_set is None:
+            self._value_set = frozenset(self)
+        return self._value_set
+
+    def add(self, value):
+        """Append a value unless it is already present."""
+        if value not in self:
+            self.append(value)
+
+    def discard(self, value):
+        """Remove every occurrence of a value, keeping the order of the
+        rest."""
+        if value in self:
+            self[:] = [x for x in self if x != value]
+
+    def joined(self):
+        """The values joined with spaces, as they appear in markup."""
+        if self._joined is None:
+            self._joined = ' '.join(self)
+        return self._joined
+
+for _name in (
+        '__setitem__', '__delitem__', '__iadd__', '__imul__',
+        'append', 'extend', 'insert', 'remove', 'pop', 'clear',
+        'sort', 'reverse'):
+    setattr(AttributeValueList, _name, _clears_caches(_name))
+del _name
+
 class HTMLAwareEntitySubstitution(EntitySubstitution):
 
     """Entity substitution rules that are aware of some HTML quirks.
@@ -127,6 +203,27 @@ class PageElement(object):
     """Contains the navigational information for some part of the page
     (either a tag or a piece of text)"""
 
+    # Tag and NavigableString keep their attributes in __slots__ rather
+    # than a per-instance __dict__, which takes a lot less memory on big
+    # documents. PageElement itself has no slots, because NavigableString
+    # also inherits from str, and the two layouts can't be combined.
+    __slots__ = ()
+
+    # The slots that every kind of element needs.
+    NODE_SLOTS = (
+        'parent', 'previous_element', 'next_element',
+        'previous_sibling', 'next_sibling', '_position_hint')
+
+    # Every change to a tree increments the mutation_version of the
+    # tree's root, so you can tell whether anything happened to a tree
+    # without serializing it. If the root has a change journal (see
+    # BeautifulSoup.start_change_journal), every change also records
+    # which part of the tree it touched. Only a BeautifulSoup object
+    # keeps these; the root of any other tree has these defaults, and
+    # its changes aren't counted.
+    mutation_version = None
+    change_journal = None
+
     # There are five possible values for the "formatter" argument passed in
     # to methods like encode() and prettify():
     #
@@ -159,7 +256,7 @@ class PageElement(object):
 
     def format_string(self, s, formatter='minimal'):
         """Format the given string using the given formatter."""
-        if not isinstance(formatter, collections.Callable):
+        if not callable(formatter):
             formatter = self._formatter_for_name(formatter)
         if formatter is None:
             output = s
@@ -205,6 +302,7 @@ class PageElement(object):
         """Sets up the initial relations between this element and
         other elements."""
         self.parent = parent
+        self._position_hint = None
 
         self.previous_element = previous_element
         if previous_element is not None:
@@ -229,6 +327,72 @@ class PageElement(object):
     nextSibling = _alias("next_sibling")  # BS3
     previousSibling = _alias("previous_sibling")  # BS3
 
+    @classmethod
+    def _slot_names(cls):
+        """Every slot of this class, including the inherited ones."""
+        names = cls.__dict__.get('_slot_names_cache')
+        if names is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name not in ('__dict__', '__weakref__'):
+                        names.append(name)
+            names = tuple(names)
+            cls._slot_names_cache = names
+        return names
+
+    def _attribute_values(self):
+        """The attributes that are set in this element's slots, as a
+        dict. This stands in for the __dict__ that elements used to have.
+        """
+        values = {}
+        for name in self._slot_names():
+            try:
+                values[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return values
+
+    def __getstate__(self):
+        return self._attribute_values()
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
+    def _clear_attributes(self):
+        """Forget every attribute of this element, like the
+        __dict__.clear() that elements used to get. Afterwards, reading
+        an attribute falls through to __getattr__ the same way."""
+        for name in self._slot_names():
+            try:
+                object.__delattr__(self, name)
+            except AttributeError:
+                pass
+        instance_dict = getattr(self, '__dict__', None)
+        if instance_dict is not None:
+            instance_dict.clear()
+
+    def _mutated(self, *inserted):
+        """Record a change to the tree this element belongs to.
+
+        :param inserted: Elements that were just put into this
+           element. Their whole subtrees are journaled as changed, since
+           everything in them has a new context.
+        :return: The root of the tree.
+        """
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if root.mutation_version is None:
+            return root
+        root.mutation_version += 1
+        if root.change_journal is not None:
+            root.change_journal.append((self, False))
+            for element in inserted:
+                root.change_journal.append((element, True))
+        return root
+
     def replace_with(self, replace_with):
         if not self.parent:
             raise ValueError(
@@ -252,9 +416,8 @@ class PageElement(object):
                 "Cannot replace an element with its contents when that"
                 "element is not part of a tree.")
         my_index = self.parent.index(self)
+        self.move_children(my_parent, position=my_index + 1)
         self.extract()
-        for child in reversed(self.contents[:]):
-            my_parent.insert(my_index, child)
         return self
     replace_with_children = unwrap
     replaceWithChildren = unwrap  # BS3
@@ -266,8 +429,11 @@ class PageElement(object):
 
     def extract(self):
         """Destructively rips this element out of the tree."""
+        root = None
         if self.parent is not None:
-            del self.parent.contents[self.parent.index(self)]
+            root = self.parent._mutated()
+            index = self.parent.index(self)
+            del self.parent.contents[index]
 
         #Find the two elements that would be next to each other if
         #this element (and any children) hadn't been parsed. Connect
@@ -291,6 +457,8 @@ class PageElement(object):
             and self.next_sibling is not self.previous_sibling):
             self.next_sibling.previous_sibling = self.previous_sibling
         self.previous_sibling = self.next_sibling = None
+        if root is not None and root.name_index is not None:
+            root.name_index.remove(self)
         return self
 
     def _last_descendant(self, is_initialized=True, accept_self=True):
@@ -372,6 +540,10 @@ class PageElement(object):
         if new_childs_last_element.next_element is not None:
             new_childs_last_element.next_element.previous_element = new_childs_last_element
         self.contents.insert(position, new_child)
+        new_child._position_hint = position
+        root = self._mutated(new_child)
+        if root.name_index is not None:
+            root.name_index.add(new_child)
 
     def append(self, tag):
         """Appends the given tag to the contents of this tag."""
@@ -515,9 +687,12 @@ class PageElement(object):
             r = l[0]
         return r
 
-    def _find_all(self, name, attrs, text, limit, generator, **kwargs):
-        "Iterates over a generator looking for things that match."
+    def _strainer(self, name, attrs, text, kwargs):
+        """The SoupStrainer for a find_* call's arguments.
 
+        Moves a 'string' argument out of kwargs and into `text`, and
+        returns both.
+        """
         if text is None and 'string' in kwargs:
             text = kwargs['string']
             del kwargs['string']
@@ -526,6 +701,25 @@ class PageElement(object):
             strainer = name
         else:
             strainer = SoupStrainer(name, attrs, text, **kwargs)
+        return strainer, text
+
+    def _search(self, strainer, generator, limit):
+        "Yields the things from a generator that match."
+        search = strainer.search
+        count = 0
+        for i in generator:
+            if i:
+                found = search(i)
+                if found:
+                    yield found
+                    count += 1
+                    if limit and count >= limit:
+                        return
+
+    def _find_all(self, name, attrs, text, limit, generator, **kwargs):
+        "Iterates over a generator looking for things that match."
+
+        strainer, text = self._strainer(name, attrs, text, kwargs)
 
         if text is None and not limit and not attrs and not kwargs:
             if name is True or name is None:
@@ -540,25 +734,16 @@ class PageElement(object):
                     prefix, name = name.split(':', 1)
                 else:
                     prefix = None
+                # The tree builders intern tag names, so most of the
+                # time a matching name is the very same string, and
+                # we skip the name property on the way.
                 result = (element for element in generator
                           if isinstance(element, Tag)
-                            and element.name == name
+                          and (element._name is name or element._name == name)
                           and (prefix is None or element.prefix == prefix)
                 )
                 return ResultSet(strainer, result)
-        results = ResultSet(strainer)
-        while True:
-            try:
-                i = next(generator)
-            except StopIteration:
-                break
-            if i:
-                found = strainer.search(i)
-                if found:
-                    results.append(found)
-                    if limit and len(results) >= limit:
-                        break
-        return results
+        return ResultSet(strainer, self._search(strainer, generator, limit))
 
     #These generators can be used to navigate starting from both
     #NavigableStrings and Tags.
@@ -632,7 +817,8 @@ class PageElement(object):
                 return tag.name == tag_name and function(tag)
             return _match
 
-    def _attribute_checker(self, operator, attribute, value=''):
+    @staticmethod
+    def _attribute_checker(operator, attribute, value=''):
         """Create a function that performs a CSS selector operation.
 
         Takes an operator, attribute and optional value. Returns a
@@ -693,6 +879,8 @@ class PageElement(object):
 
 class NavigableString(str, PageElement):
 
+    __slots__ = PageElement.NODE_SLOTS
+
     PREFIX = ''
     SUFFIX = ''
 
@@ -755,6 +943,8 @@ class PreformattedString(NavigableString):
     but the return value will be ignored.
     """
 
+    __slots__ = ()
+
     def output_ready(self, formatter="minimal"):
         """CData strings are passed into the formatter.
         But the return value is ignored."""
@@ -763,33 +953,47 @@ class PreformattedString(NavigableString):
 
 class CData(PreformattedString):
 
+    __slots__ = ()
+
     PREFIX = '<![CDATA['
     SUFFIX = ']]>'
 
 class ProcessingInstruction(PreformattedString):
     """A SGML processing instruction."""
 
+    __slots__ = ()
+
     PREFIX = '<?'
     SUFFIX = '>'
 
 class XMLProcessingInstruction(ProcessingInstruction):
     """An XML processing instruction."""
+
+    __slots__ = ()
+
     PREFIX = '<?'
     SUFFIX = '?>'
 
 class Comment(PreformattedString):
 
+    __slots__ = ()
+
     PREFIX = '<!--'
     SUFFIX = '-->'
 
 
 class Declaration(PreformattedString):
+
+    __slots__ = ()
+
     PREFIX = '<?'
     SUFFIX = '?>'
 
 
 class Doctype(PreformattedString):
 
+    __slots__ = ()
+
     @classmethod
     def for_name_and_ids(cls, name, pub_id, system_id):
         value = name or ''
@@ -810,6 +1014,15 @@ class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
 
+    __slots__ = PageElement.NODE_SLOTS + (
+        'parser_class', '_name', 'namespace', 'prefix',
+        'preserve_whitespace_tags', 'known_xml', 'attrs', 'contents',
+        'hidden', 'can_be_empty_element')
+
+    # Only a BeautifulSoup object can have a TagNameIndex (see
+    # BeautifulSoup.start_name_index); everywhere else this is None.
+    name_index = None
+
     def __init__(self, parser=None, builder=None, name=None, namespace=None,
                  prefix=None, attrs=None, parent=None, previous=None,
                  is_xml=None):
@@ -823,7 +1036,7 @@ class Tag(PageElement):
             self.parser_class = parser.__class__
         if name is None:
             raise ValueError("No value provided for new tag's name.")
-        self.name = name
+        self._name = name
         self.namespace = namespace
         self.prefix = prefix
         if builder is not None:
@@ -865,6 +1078,18 @@ class Tag(PageElement):
 
     parserClass = _alias("parser_class")  # BS3
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        old_name = self._name
+        self._name = name
+        root = self._mutated()
+        if root.name_index is not None:
+            root.name_index.rename(self, old_name)
+
     def __copy__(self):
         """A copy of a Tag is a new Tag, unconnected to the parse tree.
         Its contents are a copy of the old Tag's contents.
@@ -958,10 +1183,106 @@ class Tag(PageElement):
         i = self
         while i is not None:
             next = i.next_element
-            i.__dict__.clear()
-            i.contents = []
+            i._clear_attributes()
+            if isinstance(i, Tag):
+                i.contents = []
             i = next
 
+    def move_children(self, new_parent, start=0, end=None, position=None):
+        """Move a run of this tag's children into another tag, all at once.
+
+        self.contents[start:end] are taken out with one splice and put
+        into new_parent.contents at `position` (by default, at the end)
+        with another. Only the pointers at the edges of the run are
+        relinked, so this costs the same whether you move one child or
+        ten thousand, unlike moving the children one at a time with
+        insert().
+
+        `position` is an index into new_parent.contents as it is
+        before the move, just like in insert().
+        """
+        contents = self.contents
+        start, end, _ = slice(start, end).indices(len(contents))
+        if start >= end:
+            return
+        run = contents[start:end]
+
+        if position is None:
+            position = len(new_parent.contents)
+        position = min(position, len(new_parent.contents))
+        ancestor = new_parent
+        while ancestor is not None and ancestor.parent is not self:
+            ancestor = ancestor.parent
+        if ancestor is not None and start <= self.index(ancestor) < end:
+            raise ValueError("Cannot move a tag into itself.")
+        if new_parent is self:
+            if start <= position <= end:
+                # The children are already there.
+                return
+            if position > end:
+                position -= len(run)
+
+        first = run[0]
+        last = run[-1]
+        last_descendant = last._last_descendant(False)
+
+        # Close the gap that the run leaves behind.
+        before = first.previous_element
+        after = last_descendant.next_element
+        if before is not None:
+            before.next_element = after
+        if after is not None:
+            after.previous_element = before
+        if first.previous_sibling is not None:
+            first.previous_sibling.next_sibling = last.next_sibling
+        if last.next_sibling is not None:
+            last.next_sibling.previous_sibling = first.previous_sibling
+        del contents[start:end]
+        old_root = self._mutated()
+
+        # Open a gap at the destination and put the run in it.
+        target = new_parent.contents
+        if position == 0:
+            previous_child = None
+            before = new_parent
+        else:
+            previous_child = target[position - 1]
+            before = previous_child._last_descendant(False)
+        if position < len(target):
+            next_child = target[position]
+            after = next_child
+        else:
+            next_child = None
+            after = None
+            parent = new_parent
+            while after is None and parent is not None:
+                after = parent.next_sibling
+                parent = parent.parent
+
+        first.previous_sibling = previous_child
+        if previous_child is not None:
+            previous_child.next_sibling = first
+        last.next_sibling = next_child
+        if next_child is not None:
+            next_child.previous_sibling = last
+        first.previous_element = before
+        before.next_element = first
+        last_descendant.next_element = after
+        if after is not None:
+            after.previous_element = last_descendant
+
+        for (index, child) in enumerate(run, position):
+            child.parent = new_parent
+            child._position_hint = index
+        target[position:position] = run
+        root = new_parent._mutated(*run)
+        if old_root is not root:
+            for child in run:
+                if old_root.name_index is not None:
+                    old_root.name_index.remove(child)
+                if root.name_index is not None:
+                    root.name_index.add(child)
+
     def clear(self, decompose=False):
         """
         Extract all children. If decompose is True, decompose instead.
@@ -980,10 +1301,41 @@ class Tag(PageElement):
         """
         Find the index of a child by identity, not value. Avoids issues with
         tag.contents.index(element) getting the index of equal elements.
+
+        Every child remembers the position it was last seen at, so this
+        is usually a single comparison. An insertion or removal near the
+        element only moves it a little way, so otherwise we look
+        outwards from that position, and every child we pass on the way
+        learns its new position too.
         """
-        for i, child in enumerate(self.contents):
-            if child is element:
-                return i
+        contents = self.contents
+        count = len(contents)
+        position = getattr(element, '_position_hint', None)
+        if position is None:
+            # Nothing here has been looked up since the tree was
+            # built, so number every child at once.
+            for (i, child) in enumerate(contents):
+                child._position_hint = i
+            position = getattr(element, '_position_hint', None)
+            if position is None:
+                position = 0
+        if position < count and contents[position] is element:
+            return position
+
+        after = before = min(position, count)
+        while after < count or before > 0:
+            if after < count:
+                child = contents[after]
+                child._position_hint = after
+                if child is element:
+                    return after
+                after += 1
+            if before > 0:
+                before -= 1
+                child = contents[before]
+                child._position_hint = before
+                if child is element:
+                    return before
         raise ValueError("Tag.index: element not in tag")
 
     def get(self, key, default=None):
@@ -1002,7 +1354,26 @@ class Tag(PageElement):
     def has_attr(self, key):
         return key in self.attrs
 
+    # By default tags hash and compare by identity, so that putting a
+    # tag in a set or a dict doesn't serialize its whole subtree. A
+    # soup can be told to hash and compare its tags by their markup
+    # instead (see BeautifulSoup.__init__); a tag asks the root of its
+    # tree, and a tree that isn't in a soup uses this default.
+    hash_by_identity = True
+
+    def _hashes_by_identity(self):
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return root.hash_by_identity
+
     def __hash__(self):
+        if self._hashes_by_identity():
+            return id(self)
+        return self.structural_hash()
+
+    def structural_hash(self):
+        """A hash of this tag's markup, consistent with structurally_equal()."""
         return str(self).__hash__()
 
     def __getitem__(self, key):
@@ -1029,10 +1400,13 @@ class Tag(PageElement):
         """Setting tag[key] sets the value of the 'key' attribute for the
         tag."""
         self.attrs[key] = value
+        self._mutated()
 
     def __delitem__(self, key):
         "Deleting tag[key] deletes all 'key' attributes for the tag."
-        self.attrs.pop(key, None)
+        if key in self.attrs:
+            del self.attrs[key]
+            self._mutated()
 
     def __call__(self, *args, **kwargs):
         """Calling a tag like a function is the same as calling its
@@ -1056,6 +1430,13 @@ class Tag(PageElement):
             "'%s' object has no attribute '%s'" % (self.__class__, tag))
 
     def __eq__(self, other):
+        """Returns true iff this is the given tag, or, if this tag's soup
+        doesn't hash by identity, iff structurally_equal() does."""
+        if self._hashes_by_identity():
+            return self is other
+        return self.structurally_equal(other)
+
+    def structurally_equal(self, other):
         """Returns true iff this tag has the same name, the same attributes,
         and the same contents (recursively) as the given tag."""
         if self is other:
@@ -1068,7 +1449,11 @@ class Tag(PageElement):
             len(self) != len(other)):
             return False
         for i, my_child in enumerate(self.contents):
-            if my_child != other.contents[i]:
+            other_child = other.contents[i]
+            if isinstance(my_child, Tag):
+                if not my_child.structurally_equal(other_child):
+                    return False
+            elif my_child != other_child:
                 return False
         return True
 
@@ -1118,7 +1503,7 @@ class Tag(PageElement):
 
     def decode(self, indent_level=None,
                eventual_encoding=DEFAULT_OUTPUT_ENCODING,
-               formatter="minimal"):
+               formatter="minimal", sort_attributes=True):
         """Returns a Unicode representation of this tag and its contents.
 
         :param eventual_encoding: The tag is destined to be
@@ -1127,87 +1512,26 @@ class Tag(PageElement):
            is passed in so that it can be substituted in if the
            document contains a <META> tag that mentions the document's
            encoding.
-        """
 
-        # First off, turn a string formatter into a function. This
-        # will stop the lookup from happening over and over again.
-        if not isinstance(formatter, collections.Callable):
-            formatter = self._formatter_for_name(formatter)
-
-        attrs = []
-        if self.attrs:
-            for key, val in sorted(self.attrs.items()):
-                if val is None:
-                    decoded = key
-                else:
-                    if isinstance(val, list) or isinstance(val, tuple):
-                        val = ' '.join(val)
-                    elif not isinstance(val, str):
-                        val = str(val)
-                    elif (
-                        isinstance(val, AttributeValueWithCharsetSubstitution)
-                        and eventual_encoding is not None):
-                        val = val.encode(eventual_encoding)
-
-                    text = self.format_string(val, formatter)
-                    decoded = (
-                        str(key) + '='
-                        + EntitySubstitution.quoted_attribute_value(text))
-                attrs.append(decoded)
-        close = ''
-        closeTag = ''
-
-        prefix = ''
-        if self.prefix:
-            prefix = self.prefix + ":"
-
-        if self.is_empty_element:
-            close = '/'
-        else:
-            closeTag = '</%s%s>' % (prefix, self.name)
-
-        pretty_print = self._should_pretty_print(indent_level)
-        space = ''
-        indent_space = ''
-        if indent_level is not None:
-            indent_space = (' ' * (indent_level - 1))
-        if pretty_print:
-            space = indent_space
-            indent_contents = indent_level + 1
-        else:
-            indent_contents = None
-        contents = self.decode_contents(
-            indent_contents, eventual_encoding, formatter)
-
-        if self.hidden:
-            # This is the 'document root' object.
-            s = contents
-        else:
-            s = []
-            attribute_string = ''
-            if attrs:
-                attribute_string = ' ' + ' '.join(attrs)
-            if indent_level is not None:
-                # Even if this particular tag is not pretty-printed,
-                # we should indent up to the start of the tag.
-                s.append(indent_space)
-            s.append('<%s%s%s%s>' % (
-                    prefix, self.name, attribute_string, close))
-            if pretty_print:
-                s.append("\n")
-            s.append(contents)
-            if pretty_print and contents and contents[-1] != "\n":
-                s.append("\n")
-            if pretty_print and closeTag:
-                s.append(space)
-            s.append(closeTag)
-            if indent_level is not None and closeTag and self.next_sibling:
-                # Even if this particular tag is not pretty-printed,
-                # we're now done with the tag, and we should add a
-                # newline if appropriate.
-                s.append("\n")
-            s = ''.join(s)
-        return s
+        :param sort_attributes: If this is False, attributes are
+           written in the order they were set, rather than sorted by
+           name.
+        """
+        chunks = []
+        self._serialize(chunks, indent_level, eventual_encoding, formatter,
+                        sort_attributes, False)
+        return ''.join(chunks)
+
+    def serialize(self, sink, indent_level=None,
+                  eventual_encoding=DEFAULT_OUTPUT_ENCODING,
+                  formatter="minimal", sort_attributes=True):
+        """Write the Unicode representation of this tag and its contents
+        to `sink`, a piece at a time, rather than building one big
+        string. `sink` is a list or a file-like object with a write()
+        method. The other arguments are the same as for decode().
+        """
+        self._serialize(sink, indent_level, eventual_encoding, formatter,
+                        sort_attributes, False)
 
     def prettify(self, encoding=None, formatter="minimal"):
         if encoding is None:
@@ -1217,7 +1541,7 @@ class Tag(PageElement):
 
     def decode_contents(self, indent_level=None,
                        eventual_encoding=DEFAULT_OUTPUT_ENCODING,
-                       formatter="minimal"):
+                       formatter="minimal", sort_attributes=True):
         """Renders the contents of this tag as a Unicode string.
 
         :param indent_level: Each line of the rendering will be
@@ -1232,30 +1556,202 @@ class Tag(PageElement):
 
         :param formatter: The output formatter responsible for converting
            entities to Unicode characters.
+
+        :param sort_attributes: If this is False, attributes are
+           written in the order they were set, rather than sorted by
+           name.
+        """
+        chunks = []
+        self._serialize(chunks, indent_level, eventual_encoding, formatter,
+                        sort_attributes, True)
+        return ''.join(chunks)
+
+    def _decode_attrs(self, eventual_encoding, formatter, sort_attributes,
+                      cache=None):
+        """The attributes of this tag, as they go in its start tag.
+
+        :param cache: A dict to remember formatted attributes in. The
+           same class or style attribute tends to show up over and over
+           in a document, so _serialize() passes in one dict for the
+           whole tree.
+        """
+        items = self.attrs.items()
+        if sort_attributes and len(self.attrs) > 1:
+            items = sorted(items)
+        attrs = []
+        for key, val in items:
+            if val is None:
+                decoded = key
+            else:
+                if isinstance(val, AttributeValueList):
+                    val = val.joined()
+                elif isinstance(val, list) or isinstance(val, tuple):
+                    val = ' '.join(val)
+                elif not isinstance(val, str):
+                    val = str(val)
+                elif (
+                    isinstance(val, AttributeValueWithCharsetSubstitution)
+                    and eventual_encoding is not None):
+                    val = val.encode(eventual_encoding)
+
+                decoded = None
+                if cache is not None and type(val) is str:
+                    cache_key = (key, val)
+                    decoded = cache.get(cache_key)
+                if decoded is None:
+                    text = val
+                    if formatter is not None:
+                        text = formatter(val)
+                    decoded = (
+                        str(key) + '='
+                        + EntitySubstitution.quoted_attribute_value(text))
+                    if cache is not None and type(val) is str:
+                        cache[cache_key] = decoded
+            attrs.append(decoded)
+        return ' ' + ' '.join(attrs)
+
+    def _serialize(self, sink, indent_level, eventual_encoding, formatter,
+                   sort_attributes, contents_only):
+        """Write this tag (or just its contents) to `sink`.
+
+        This does what calling decode() on every tag in the tree would
+        do, but with a stack instead of recursion, so deeply nested
+        documents don't hit the recursion limit, and nothing is joined
+        together until the very end.
         """
         # First off, turn a string formatter into a function. This
         # will stop the lookup from happening over and over again.
-        if not isinstance(formatter, collections.Callable):
+        if not callable(formatter):
             formatter = self._formatter_for_name(formatter)
+        if isinstance(sink, list):
+            write = sink.append
+        else:
+            write = sink.write
+
+        # Formatted attributes, by name and value.
+        attribute_cache = {}
+
+        # The last non-empty chunk written, and how many chunks have
+        # been written. A pretty-printed tag's contents get a newline at the
+        # end unless they already have one.
+        last = ''
+        written = 0
+
+        # Each frame is a tag being written: the tag, an iterator over
+        # its contents, the indent level the tag is at, the indent
+        # level of its contents, whether it's pretty-printed, its
+        # closing tag, and `written` as it was after the start tag.
+        stack = []
+        if contents_only:
+            # Only the contents of this tag get written, so it doesn't
+            # get a closing tag either.
+            stack.append([self, iter(self.contents), None, indent_level,
+                          False, None, 0])
+            opening = None
+        else:
+            opening = self
+            level = indent_level
 
-        pretty_print = (indent_level is not None)
-        s = []
-        for c in self:
-            text = None
-            if isinstance(c, NavigableString):
-                text = c.output_ready(formatter)
-            elif isinstance(c, Tag):
-                s.append(c.decode(indent_level, eventual_encoding,
-                                  formatter))
-            if text and indent_level and not self.name == 'pre':
-                text = text.strip()
-            if text:
-                if pretty_print and not self.name == 'pre':
-                    s.append(" " * (indent_level - 1))
-                s.append(text)
-                if pretty_print and not self.name == 'pre':
-                    s.append("\n")
-        return ''.join(s)
+        while True:
+            if opening is not None:
+                tag = opening
+                opening = None
+                pretty_print = tag._should_pretty_print(level)
+                prefix = ''
+                if tag.prefix:
+                    prefix = tag.prefix + ":"
+                if tag.is_empty_element:
+                    close = '/'
+                    close_tag = ''
+                else:
+                    close = ''
+                    close_tag = '</%s%s>' % (prefix, tag.name)
+                if tag.hidden:
+                    # This is the 'document root' object.
+                    close_tag = None
+                else:
+                    attribute_string = ''
+                    if tag.attrs:
+                        attribute_string = tag._decode_attrs(
+                            eventual_encoding, formatter, sort_attributes,
+                            attribute_cache)
+                    if level is not None and level > 1:
+                        # Even if this particular tag is not
+                        # pretty-printed, we should indent up to the
+                        # start of the tag.
+                        last = ' ' * (level - 1)
+                        write(last)
+                        written += 1
+                    last = '<%s%s%s%s>' % (
+                        prefix, tag.name, attribute_string, close)
+                    write(last)
+                    written += 1
+                    if pretty_print:
+                        last = "\n"
+                        write(last)
+                        written += 1
+                if pretty_print:
+                    contents_level = level + 1
+                else:
+                    contents_level = None
+                stack.append([tag, iter(tag.contents), level, contents_level,
+                              pretty_print, close_tag, written])
+
+            (tag, children, level, contents_level, pretty_print, close_tag,
+             start) = stack[-1]
+            indent_strings = contents_level is not None and tag.name != 'pre'
+            for c in children:
+                if isinstance(c, NavigableString):
+                    if type(c) is NavigableString:
+                        if formatter is None:
+                            text = c
+                        else:
+                            text = formatter(c)
+                    else:
+                        text = c.output_ready(formatter)
+                    if text and indent_strings:
+                        if contents_level:
+                            text = text.strip()
+                        if text:
+                            if contents_level > 1:
+                                write(' ' * (contents_level - 1))
+                            write(text)
+                            last = "\n"
+                            write(last)
+                            written += 1
+                    elif text:
+                        last = text
+                        write(last)
+                        written += 1
+                elif isinstance(c, Tag):
+                    opening = c
+                    level = contents_level
+                    break
+            if opening is not None:
+                continue
+
+            # That's all of this tag's contents. Close it.
+            stack.pop()
+            if close_tag is not None:
+                if pretty_print and written > start and last[-1] != "\n":
+                    last = "\n"
+                    write(last)
+                    written += 1
+                if close_tag:
+                    if pretty_print and level > 1:
+                        write(' ' * (level - 1))
+                    last = close_tag
+                    write(last)
+                    written += 1
+                    if level is not None and tag.next_sibling:
+                        # Even if this particular tag is not
+                        # pretty-printed, we're now done with the tag,
+                        # and we should add a newline if appropriate.
+                        last = "\n"
+                        write(last)
+                        written += 1
+            if not stack:
+                break
 
     def encode_contents(
         self, indent_level=None, encoding=DEFAULT_OUTPUT_ENCODING,
@@ -1307,6 +1803,21 @@ class Tag(PageElement):
         string matches for some custom definition of 'matches'. The
         same is true of the tag name."""
 
+        # A decomposed tag has no contents, and no parent to walk up
+        # to either, so it doesn't get this far.
+        if (recursive and self.contents and isinstance(name, str)
+            and ':' not in name and not attrs and text is None
+            and not kwargs):
+            root = self
+            while root.parent is not None:
+                root = root.parent
+            if root.name_index is not None:
+                # Answer a query by name alone from the index.
+                found = root.name_index.find_all(name, self)
+                if limit:
+                    found = found[:limit]
+                return ResultSet(SoupStrainer(name), found)
+
         generator = self.descendants
         if not recursive:
             generator = self.children
@@ -1314,6 +1825,48 @@ class Tag(PageElement):
     findAll = find_all       # BS3
     findChildren = find_all  # BS2
 
+    def iter_find_all(self, name=None, attrs={}, recursive=True, text=None,
+                      limit=None, **kwargs):
+        """Like find_all(), but yields the matches one at a time, in
+        document order, instead of collecting them in a list. Once
+        `limit` matches have been found, the rest of the tree isn't
+        looked at.
+
+        The tree is walked as you go, so what you do to it in between
+        matches counts. You can modify the element you were just
+        given, or take it out of the tree with extract(), decompose(),
+        replace_with() or unwrap(); the walk carries on with whatever
+        ends up in its place, so a replacement or unwrapped children
+        get looked at too. Elements added inside it are looked at as
+        well. Removing or moving other elements that haven't been
+        reached yet may make the walk skip or repeat elements.
+
+        Unlike find_all(), this doesn't use the soup's name index.
+        """
+        strainer, text = self._strainer(name, attrs, text, kwargs)
+        if recursive:
+            generator = self._live_descendants()
+        else:
+            generator = self._live_children()
+        return self._search(strainer, generator, limit)
+
+    def _live_descendants(self):
+        """Like .descendants, but you can take out the element you
+        were just given. See iter_find_all()."""
+        if not self.contents:
+            return iter(())
+        return _walk(self, self.contents[0],
+                     self._last_descendant().next_element,
+                     'next_element', 'previous_element')
+
+    def _live_children(self):
+        """Like .children, but you can take out the element you were
+        just given. See iter_find_all()."""
+        if not self.contents:
+            return iter(())
+        return _walk(self, self.contents[0], None,
+                     'next_sibling', 'previous_sibling')
+
     #Generator methods
     @property
     def children(self):
@@ -1342,225 +1895,32 @@ class Tag(PageElement):
             return value[0]
         return None
 
-    def select(self, selector, _candidate_generator=None, limit=None):
-        """Perform a CSS selection operation on the current element."""
-
-        # Handle grouping selectors if ',' exists, ie: p,a
-        if ',' in selector:
-            context = []
-            for partial_selector in selector.split(','):
-                partial_selector = partial_selector.strip()
-                if partial_selector == '':
-                    raise ValueError('Invalid group selection syntax: %s' % selector)
-                candidates = self.select(partial_selector, limit=limit)
-                for candidate in candidates:
-                    if candidate not in context:
-                        context.append(candidate)
-
-                if limit and len(context) >= limit:
-                    break
-            return context
-        tokens = shlex.split(selector)
-        current_context = [self]
-
-        if tokens[-1] in self._selector_combinators:
-            raise ValueError(
-                'Final combinator "%s" is missing an argument.' % tokens[-1])
+    def select(self, selector, limit=None):
+        """Perform a CSS selection operation on the current element.
 
+        The selector is parsed once and kept in a cache (see
+        compile_selector). The matching tags are found in one pass over
+        the tree, and are returned in document order, even if the
+        selector is a group like "p, a".
+        """
         if self._select_debug:
             print('Running CSS selector "%s"' % selector)
-
-        for index, token in enumerate(tokens):
-            new_context = []
-            new_context_ids = set([])
-
-            if tokens[index-1] in self._selector_combinators:
-                # This token was consumed by the previous combinator. Skip it.
-                if self._select_debug:
-                    print('  Token was consumed by the previous combinator.')
-                continue
-
-            if self._select_debug:
-                print(' Considering token "%s"' % token)
-            recursive_candidate_generator = None
-            tag_name = None
-
-            # Each operation corresponds to a checker function, a rule
-            # for determining whether a candidate matches the
-            # selector. Candidates are generated by the active
-            # iterator.
-            checker = None
-
-            m = self.attribselect_re.match(token)
-            if m is not None:
-                # Attribute selector
-                tag_name, attribute, operator, value = m.groups()
-                checker = self._attribute_checker(operator, attribute, value)
-
-            elif '#' in token:
-                # ID selector
-                tag_name, tag_id = token.split('#', 1)
-                def id_matches(tag):
-                    return tag.get('id', None) == tag_id
-                checker = id_matches
-
-            elif '.' in token:
-                # Class selector
-                tag_name, klass = token.split('.', 1)
-                classes = set(klass.split('.'))
-                def classes_match(candidate):
-                    return classes.issubset(candidate.get('class', []))
-                checker = classes_match
-
-            elif ':' in token and not self.quoted_colon.search(token):
-                # Pseudo-class
-                tag_name, pseudo = token.split(':', 1)
-                if tag_name == '':
-                    raise ValueError(
-                        "A pseudo-class must be prefixed with a tag name.")
-                pseudo_attributes = re.match('([a-zA-Z\d-]+)\(([a-zA-Z\d]+)\)', pseudo)
-                found = []
-                if pseudo_attributes is None:
-                    pseudo_type = pseudo
-                    pseudo_value = None
-                else:
-                    pseudo_type, pseudo_value = pseudo_attributes.groups()
-                if pseudo_type == 'nth-of-type':
-                    try:
-                        pseudo_value = int(pseudo_value)
-                    except:
-                        raise NotImplementedError(
-                            'Only numeric values are currently supported for the nth-of-type pseudo-class.')
-                    if pseudo_value < 1:
-                        raise ValueError(
-                            'nth-of-type pseudo-class value must be at least 1.')
-                    class Counter(object):
-                        def __init__(self, destination):
-                            self.count = 0
-                            self.destination = destination
-
-                        def nth_child_of_type(self, tag):
-                            self.count += 1
-                            if self.count == self.destination:
-                                return True
-                            else:
-                                return False
-                    checker = Counter(pseudo_value).nth_child_of_type
-                else:
-                    raise NotImplementedError(
-                        'Only the following pseudo-classes are implemented: nth-of-type.')
-
-            elif token == '*':
-                # Star selector -- matches everything
-                pass
-            elif token == '>':
-                # Run the next token as a CSS selector against the
-                # direct children of each tag in the current context.
-                recursive_candidate_generator = lambda tag: tag.children
-            elif token == '~':
-                # Run the next token as a CSS selector against the
-                # siblings of each tag in the current context.
-                recursive_candidate_generator = lambda tag: tag.next_siblings
-            elif token == '+':
-                # For each tag in the current context, run the next
-                # token as a CSS selector against the tag's next
-                # sibling that's a tag.
-                def next_tag_sibling(tag):
-                    yield tag.find_next_sibling(True)
-                recursive_candidate_generator = next_tag_sibling
-
-            elif self.tag_name_re.match(token):
-                # Just a tag name.
-                tag_name = token
-            else:
-                raise ValueError(
-                    'Unsupported or invalid CSS selector: "%s"' % token)
-            if recursive_candidate_generator:
-                # This happens when the selector looks like  "> foo".
-                #
-                # The generator calls select() recursively on every
-                # member of the current context, passing in a different
-                # candidate generator and a different selector.
-                #
-                # In the case of "> foo", the candidate generator is
-                # one that yields a tag's direct children (">"), and
-                # the selector is "foo".
-                next_token = tokens[index+1]
-                def recursive_select(tag):
-                    if self._select_debug:
-                        print('    Calling select("%s") recursively on %s %s' % (next_token, tag.name, tag.attrs))
-                        print('-' * 40)
-                    for i in tag.select(next_token, recursive_candidate_generator):
-                        if self._select_debug:
-                            print('(Recursive select picked up candidate %s %s)' % (i.name, i.attrs))
-                        yield i
-                    if self._select_debug:
-                        print('-' * 40)
-                _use_candidate_generator = recursive_select
-            elif _candidate_generator is None:
-                # By default, a tag's candidates are all of its
-                # children. If tag_name is defined, only yield tags
-                # with that name.
-                if self._select_debug:
-                    if tag_name:
-                        check = "[any]"
-                    else:
-                        check = tag_name
-                    print('   Default candidate generator, tag name="%s"' % check)
-                if self._select_debug:
-                    # This is redundant with later code, but it stops
-                    # a bunch of bogus tags from cluttering up the
-                    # debug log.
-                    def default_candidate_generator(tag):
-                        for child in tag.descendants:
-                            if not isinstance(child, Tag):
-                                continue
-                            if tag_name and not child.name == tag_name:
-                                continue
-                            yield child
-                    _use_candidate_generator = default_candidate_generator
-                else:
-                    _use_candidate_generator = lambda tag: tag.descendants
-            else:
-                _use_candidate_generator = _candidate_generator
-
-            count = 0
-            for tag in current_context:
-                if self._select_debug:
-                    print("    Running candidate generator on %s %s" % (
-                        tag.name, repr(tag.attrs)))
-                for candidate in _use_candidate_generator(tag):
-                    if not isinstance(candidate, Tag):
-                        continue
-                    if tag_name and candidate.name != tag_name:
-                        continue
-                    if checker is not None:
-                        try:
-                            result = checker(candidate)
-                        except StopIteration:
-                            # The checker has decided we should no longer
-                            # run the generator.
-                            break
-                    if checker is None or result:
-                        if self._select_debug:
-                            print("     SUCCESS %s %s" % (candidate.name, repr(candidate.attrs)))
-                        if id(candidate) not in new_context_ids:
-                            # If a tag matches a selector more than once,
-                            # don't include it in the context more than once.
-                            new_context.append(candidate)
-                            new_context_ids.add(id(candidate))
-                    elif self._select_debug:
-                        print("     FAILURE %s %s" % (candidate.name, repr(candidate.attrs)))
-
-            current_context = new_context
-        if limit and len(current_context) >= limit:
-            current_context = current_context[:limit]
-
+        found = compile_selector(selector).select(self, limit)
         if self._select_debug:
             print("Final verdict:")
-            for i in current_context:
+            for i in found:
                 print(" %s %s" % (i.name, i.attrs))
-        return current_context
+        return found
+
+    def iter_select(self, selector, limit=None):
+        """Like select(), but yields the matching tags one at a time, in
+        document order. Once `limit` tags have been found, the rest of
+        the tree isn't looked at.
+
+        What you can do to the tree while iterating is the same as for
+        iter_find_all().
+        """
+        return compile_selector(selector).iselect(self, limit)
 
     # Old names for backwards compatibility
     def childGenerator(self):
@@ -1577,6 +1937,359 @@ class Tag(PageElement):
                 key))
         return self.has_attr(key)
 
+class CSSSelector(object):
+    """A CSS selector, parsed into a program that says whether any one
+    tag matches it.
+
+    Each selector in a group becomes a list of steps, one per compound
+    selector such as "p.intro". A step is a combinator (' ' for
+    descendant, '>', '~' or '+') and a test for the tag itself. The
+    combinator of the first step relates the tag to the one select()
+    was called on. Tags are matched from the last step backwards, the
+    way browsers do it.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        if ',' in selector:
+            # Handle grouping selectors, ie: p,a
+            parts = []
+            for partial_selector in selector.split(','):
+                partial_selector = partial_selector.strip()
+                if partial_selector == '':
+                    raise ValueError(
+                        'Invalid group selection syntax: %s' % selector)
+                parts.append(partial_selector)
+        else:
+            parts = [selector]
+        self.programs = [self._parse(part) for part in parts]
+
+    def _parse(self, selector):
+        tokens = shlex.split(selector)
+        if tokens[-1] in Tag._selector_combinators:
+            raise ValueError(
+                'Final combinator "%s" is missing an argument.' % tokens[-1])
+        steps = []
+        combinator = ' '
+        for index, token in enumerate(tokens):
+            if token in Tag._selector_combinators:
+                if index > 0 and tokens[index-1] in Tag._selector_combinators:
+                    raise ValueError(
+                        'Combinator "%s" is missing an argument.'
+                        % tokens[index-1])
+                combinator = token
+                continue
+            steps.append((combinator, self._compound(token)))
+            combinator = ' '
+        return steps
+
+    def _compound(self, token):
+        """Turn one compound selector into a function that tests a tag."""
+        tag_name = None
+        checker = None
+
+        m = Tag.attribselect_re.match(token)
+        if m is not None:
+            # Attribute selector
+            tag_name, attribute, operator, value = m.groups()
+            checker = PageElement._attribute_checker(
+                operator, attribute, value)
+
+        elif '#' in token:
+            # ID selector
+            tag_name, tag_id = token.split('#', 1)
+            def id_matches(tag):
+                return tag.get('id', None) == tag_id
+            checker = id_matches
+
+        elif '.' in token:
+            # Class selector
+            tag_name, klass = token.split('.', 1)
+            classes = set(klass.split('.'))
+            def classes_match(candidate):
+                value = candidate.get('class', [])
+                if isinstance(value, AttributeValueList):
+                    value = value.value_set
+                return classes.issubset(value)
+            checker = classes_match
+
+        elif ':' in token and not Tag.quoted_colon.search(token):
+            # Pseudo-class
+            tag_name, pseudo = token.split(':', 1)
+            if tag_name == '':
+                raise ValueError(
+                    "A pseudo-class must be prefixed with a tag name.")
+            pseudo_attributes = re.match(
+                r'([a-zA-Z\d-]+)\(([a-zA-Z\d]+)\)', pseudo)
+            if pseudo_attributes is None:
+                pseudo_type = pseudo
+                pseudo_value = None
+            else:
+                pseudo_type, pseudo_value = pseudo_attributes.groups()
+            if pseudo_type == 'nth-of-type':
+                try:
+                    pseudo_value = int(pseudo_value)
+                except:
+                    raise NotImplementedError(
+                        'Only numeric values are currently supported for the nth-of-type pseudo-class.')
+                if pseudo_value < 1:
+                    raise ValueError(
+                        'nth-of-type pseudo-class value must be at least 1.')
+                def nth_of_type(tag):
+                    # Count this tag and the earlier siblings with the
+                    # same name.
+                    count = 1
+                    for sibling in tag.previous_siblings:
+                        if (isinstance(sibling, Tag)
+                            and sibling.name == tag.name):
+                            count += 1
+                            if count > pseudo_value:
+                                return False
+                    return count == pseudo_value
+                checker = nth_of_type
+            else:
+                raise NotImplementedError(
+                    'Only the following pseudo-classes are implemented: nth-of-type.')
+
+        elif token == '*':
+            # Star selector -- matches everything
+            pass
+        elif Tag.tag_name_re.match(token):
+            # Just a tag name.
+            tag_name = token
+        else:
+            raise ValueError(
+                'Unsupported or invalid CSS selector: "%s"' % token)
+
+        if tag_name and checker is not None:
+            def test(tag):
+                return tag.name == tag_name and checker(tag)
+        elif tag_name:
+            def test(tag):
+                return tag.name == tag_name
+        elif checker is not None:
+            test = checker
+        else:
+            def test(tag):
+                return True
+        return test
+
+    def _matches(self, steps, i, tag, start, stop):
+        """Does `tag` match steps[:i+1], with the first step relative
+        to `start`? The search for earlier steps never goes up as far
+        as `stop`.
+        """
+        combinator, test = steps[i]
+        if not test(tag):
+            return False
+        if i == 0:
+            if combinator == ' ':
+                return True
+            if combinator == '>':
+                return tag.parent is start
+            if combinator == '+':
+                return _previous_tag_sibling(tag) is start
+            return any(sibling is start for sibling in tag.previous_siblings)
+        if combinator == ' ':
+            ancestor = tag.parent
+            while ancestor is not None and ancestor is not stop:
+                if self._matches(steps, i-1, ancestor, start, stop):
+                    return True
+                ancestor = ancestor.parent
+            return False
+        if combinator == '>':
+            parent = tag.parent
+            return (parent is not None and parent is not stop
+                    and self._matches(steps, i-1, parent, start, stop))
+        if combinator == '+':
+            sibling = _previous_tag_sibling(tag)
+            return (sibling is not None
+                    and self._matches(steps, i-1, sibling, start, stop))
+        for sibling in tag.previous_siblings:
+            if (isinstance(sibling, Tag)
+                and self._matches(steps, i-1, sibling, start, stop)):
+                return True
+        return False
+
+    def select(self, start, limit=None):
+        """Find the tags that match, relative to `start`."""
+        return list(self.iselect(start, limit, live=False))
+
+    def iselect(self, start, limit=None, live=True):
+        """Yield the tags that match, relative to `start`.
+
+        :param live: If this is True, the caller may take each tag out
+           of the tree as it's yielded; see Tag.iter_find_all().
+        """
+        inside = []
+        after = []
+        for steps in self.programs:
+            if steps[0][0] in ('~', '+'):
+                after.append(steps)
+            else:
+                inside.append(steps)
+
+        count = 0
+        # Selectors that start with a sibling combinator match tags
+        # after `start` rather than inside it.
+        for (programs, candidates, stop) in (
+            (inside, start._live_descendants() if live
+             else start.descendants, start),
+            (after, _following_subtrees(start), start.parent)):
+            if not programs:
+                continue
+            for candidate in candidates:
+                if not isinstance(candidate, Tag):
+                    continue
+                for steps in programs:
+                    if self._matches(
+                            steps, len(steps) - 1, candidate, start, stop):
+                        yield candidate
+                        count += 1
+                        if limit and count >= limit:
+                            return
+                        break
+
+
+def _previous_tag_sibling(tag):
+    sibling = tag.previous_sibling
+    while sibling is not None and not isinstance(sibling, Tag):
+        sibling = sibling.previous_sibling
+    return sibling
+
+
+def _following_subtrees(element):
+    """The siblings after `element`, and everything inside them, in
+    document order."""
+    parent = element.parent
+    if parent is None:
+        return iter(())
+    return _walk(parent, element._last_descendant().next_element,
+                 parent._last_descendant().next_element,
+                 'next_element', 'previous_element')
+
+
+def _walk(root, first, stop, forward, back):
+    """Yield `first` and the elements after it, up to `stop`, following
+    the `forward` links (next_element or next_sibling).
+
+    If the consumer takes the element it was just given out of the
+    tree, carry on from the element before it (by the `back` link),
+    or from the start of `root` if there isn't one.
+    """
+    current = first
+    while current is not None and current is not stop:
+        parent = current.parent
+        previous = getattr(current, back)
+        yield current
+        # A decomposed tag has no parent slot; reading it gives None.
+        if getattr(current, 'parent', None) is parent:
+            current = getattr(current, forward)
+        elif previous is not None:
+            current = getattr(previous, forward)
+        elif root.contents:
+            current = root.contents[0]
+        else:
+            current = None
+
+
+# Tag.select() parses each distinct selector once. This many parsed
+# selectors are kept around.
+SELECTOR_CACHE_SIZE = 256
+compile_selector = functools.lru_cache(maxsize=SELECTOR_CACHE_SIZE)(
+    CSSSelector)
+
+
+class TagNameIndex(object):
+    """Every Tag in a tree, grouped by name.
+
+    The index is kept up to date by insert(), extract(), decompose(),
+    move_children() and renaming a tag. It can't see changes made by
+    modifying a tag's .contents directly.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        # Maps a name to a dict of id(tag): tag.
+        self.tags = {}
+        # Maps a name to (root.mutation_version, tags in document order).
+        self._ordered = {}
+        for descendant in root.descendants:
+            if isinstance(descendant, Tag):
+                self._add(descendant)
+
+    def _add(self, tag):
+        bucket = self.tags.get(tag._name)
+        if bucket is None:
+            bucket = self.tags[tag._name] = {}
+        bucket[id(tag)] = tag
+
+    def _remove(self, tag, name):
+        bucket = self.tags.get(name)
+        if bucket is not None and bucket.pop(id(tag), None) is not None:
+            if not bucket:
+                del self.tags[name]
+            return True
+        return False
+
+    def add(self, element):
+        """Index an element that was put into the tree, and everything
+        beneath it."""
+        if isinstance(element, Tag):
+            self._add(element)
+            for descendant in element.descendants:
+                if isinstance(descendant, Tag):
+                    self._add(descendant)
+
+    def remove(self, element):
+        """Forget an element that was taken out of the tree, and
+        everything beneath it."""
+        if isinstance(element, Tag):
+            self._remove(element, element._name)
+            for descendant in element.descendants:
+                if isinstance(descendant, Tag):
+                    self._remove(descendant, descendant._name)
+
+    def rename(self, tag, old_name):
+        """Move a tag that used to be called `old_name`."""
+        if self._remove(tag, old_name):
+            self._add(tag)
+
+    def _position(self, element):
+        """The path of child indexes from the root down to `element`.
+        Sorting by it puts elements in document order."""
+        path = []
+        while element.parent is not None:
+            path.append(element.parent.index(element))
+            element = element.parent
+        path.reverse()
+        return tuple(path)
+
+    def find_all(self, name, within=None):
+        """All the tags with the given name, in document order.
+
+        :param within: If this is a tag other than the root, only tags
+           beneath it are returned.
+        """
+        bucket = self.tags.get(name)
+        if not bucket:
+            return []
+        version = self.root.mutation_version
+        cached = self._ordered.get(name)
+        if cached is not None and cached[0] == version:
+            positions = cached[1]
+        else:
+            positions = sorted(
+                (self._position(tag), tag) for tag in bucket.values())
+            self._ordered[name] = (version, positions)
+        if within is None or within is self.root:
+            return [tag for (position, tag) in positions]
+        prefix = self._position(within)
+        depth = len(prefix)
+        return [tag for (position, tag) in positions
+                if len(position) > depth and position[:depth] == prefix]
+
+
 # Next, a couple classes to represent queries and their results.
 class SoupStrainer(object):
     """Encapsulates a number of ways of matching a markup element (tag or
@@ -1608,11 +2321,12 @@ class SoupStrainer(object):
 
         self.attrs = normalized_attrs
         self.text = self._normalize_search_value(text)
+        self._compile()
 
     def _normalize_search_value(self, value):
         # Leave it alone if it's a Unicode string, a callable, a
         # regular expression, a boolean, or None.
-        if (isinstance(value, str) or isinstance(value, collections.Callable) or hasattr(value, 'match')
+        if (isinstance(value, str) or callable(value) or hasattr(value, 'match')
             or isinstance(value, bool) or value is None):
             return value
 
@@ -1645,43 +2359,196 @@ class SoupStrainer(object):
         else:
             return "%s|%s" % (self.name, self.attrs)
 
+    def _compile(self):
+        """Turn the name, attrs and text criteria into functions, so
+        that checking an element doesn't have to work out what kind of
+        criteria they are all over again.
+
+        If you change .name, .attrs or .text after creating the
+        strainer, call this again.
+        """
+        self._name_matches = None
+        if self.name:
+            self._name_matches = self._matcher(self.name)
+        self._attr_matches = [
+            (attr, self._matcher(match_against))
+            for attr, match_against in list(self.attrs.items())]
+        self._text_matches = self._matcher(self.text)
+        self._string_matches = None
+        if self.text:
+            self._string_matches = self._text_matches
+        self._searches_tags = bool(not self.text or self.name or self.attrs)
+        self._searches_strings = not self.name and not self.attrs
+
+        name_matches = self._name_matches
+        attr_matches = self._attr_matches
+        string_matches = self._string_matches
+        def tag_matches(tag):
+            if name_matches is not None and not name_matches(tag):
+                return False
+            if attr_matches:
+                get = tag.attrs.get
+                for attr, matches in attr_matches:
+                    if not matches(get(attr)):
+                        return False
+            if string_matches is not None and not string_matches(tag.string):
+                return False
+            return True
+        self._tag_matches = tag_matches
+
+    # The attributes _compile() sets. They're closures, which can't be
+    # pickled, so they're left out of the pickle and compiled again.
+    COMPILED_ATTRIBUTES = (
+        '_name_matches', '_attr_matches', '_text_matches',
+        '_string_matches', '_searches_tags', '_searches_strings',
+        '_tag_matches')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in self.COMPILED_ATTRIBUTES:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _matcher(self, match_against, already_tried=None):
+        """Compile a normalized search value into a function that
+        takes a tag, a string, an attribute value or None, and says
+        whether it matches.
+        """
+        if match_against is True:
+            # True matches any non-None value.
+            def match(markup):
+                return markup is not None
+        elif callable(match_against):
+            match = match_against
+        else:
+            match = self._value_matcher(match_against, already_tried)
+
+        def matches(markup):
+            if isinstance(markup, (list, tuple)):
+                # This should only happen when searching a
+                # multi-valued attribute like 'class'. Match any one
+                # value, or all of them considered as a string.
+                for item in markup:
+                    if matches(item):
+                        return True
+                return bool(matches(' '.join(markup)))
+            return match(markup)
+        return matches
+
+    def _value_matcher(self, match_against, already_tried):
+        """The part of _matcher() for strings, regular expressions,
+        lists and the false values, all of which match against a tag's
+        name rather than the tag itself.
+        """
+        normalize = self._normalize_search_value
+        # None matches None, False, an empty string, an empty list,
+        # and so on.
+        if_none = not match_against
+
+        if (hasattr(match_against, '__iter__')
+            and not isinstance(match_against, str)):
+            # The markup must match at least one item in the iterable.
+            # To avoid infinite recursion we need to keep track of
+            # items we've already seen.
+            if already_tried is None:
+                already_tried = set()
+            options = []
+            for item in match_against:
+                if item.__hash__:
+                    key = item
+                else:
+                    key = id(item)
+                if key not in already_tried:
+                    already_tried.add(key)
+                    options.append(self._matcher(item, already_tried))
+
+            def match(markup):
+                name = markup
+                if isinstance(markup, Tag):
+                    name = markup.name
+                if name is None or normalize(name) is None:
+                    return if_none
+                for option in options:
+                    if option(markup):
+                        return True
+                return False
+            return match
+
+        if isinstance(match_against, str):
+            # Exact string match, possibly of the prefixed tag name.
+            def match(markup):
+                if isinstance(markup, Tag):
+                    if markup.name == match_against:
+                        return True
+                    return bool(
+                        markup.prefix
+                        and markup.prefix + ':' + markup.name == match_against)
+                if markup is None:
+                    return if_none
+                if not isinstance(markup, str):
+                    markup = normalize(markup)
+                    if markup is None:
+                        return if_none
+                return markup == match_against
+            return match
+
+        if hasattr(match_against, 'search'):
+            # Regexp match.
+            search = match_against.search
+            def match(markup):
+                if isinstance(markup, Tag):
+                    markup = markup.name
+                if markup is None:
+                    return if_none
+                if not isinstance(markup, str):
+                    markup = normalize(markup)
+                    if markup is None:
+                        return if_none
+                return search(markup)
+            return match
+
+        # Anything else matches nothing but None.
+        def match(markup):
+            if isinstance(markup, Tag):
+                markup = markup.name
+            return markup is None and if_none
+        return match
+
     def search_tag(self, markup_name=None, markup_attrs={}):
-        found = None
-        markup = None
         if isinstance(markup_name, Tag):
-            markup = markup_name
-            markup_attrs = markup
-        call_function_with_tag_data = (
-            isinstance(self.name, collections.Callable)
-            and not isinstance(markup_name, Tag))
-
-        if ((not self.name)
-            or call_function_with_tag_data
-            or (markup and self._matches(markup, self.name))
-            or (not markup and self._matches(markup_name, self.name))):
-            if call_function_with_tag_data:
+            if self._tag_matches(markup_name):
+                return markup_name
+            return None
+
+        # The tree builder is asking whether to create a tag with this
+        # name and these attributes.
+        found = None
+        if (self._name_matches is None
+            or callable(self.name)
+            or self._name_matches(markup_name)):
+            if callable(self.name):
                 match = self.name(markup_name, markup_attrs)
             else:
                 match = True
-                markup_attr_map = None
-                for attr, match_against in list(self.attrs.items()):
-                    if not markup_attr_map:
-                        if hasattr(markup_attrs, 'get'):
-                            markup_attr_map = markup_attrs
-                        else:
-                            markup_attr_map = {}
-                            for k, v in markup_attrs:
-                                markup_attr_map[k] = v
-                    attr_value = markup_attr_map.get(attr)
-                    if not self._matches(attr_value, match_against):
-                        match = False
-                        break
+                if self._attr_matches:
+                    if hasattr(markup_attrs, 'get'):
+                        markup_attr_map = markup_attrs
+                    else:
+                        markup_attr_map = {}
+                        for k, v in markup_attrs:
+                            markup_attr_map[k] = v
+                    for attr, matches in self._attr_matches:
+                        if not matches(markup_attr_map.get(attr)):
+                            match = False
+                            break
             if match:
-                if markup:
-                    found = markup
-                else:
-                    found = markup_name
-        if found and self.text and not self._matches(found.string, self.text):
+                found = markup_name
+        if (found and self._string_matches is not None
+            and not self._string_matches(found.string)):
             found = None
         return found
     searchTag = search_tag
@@ -1689,110 +2556,30 @@ class SoupStrainer(object):
     def search(self, markup):
         # print 'looking for %s in %s' % (self, markup)
         found = None
+        # If it's a Tag, make sure its name or attributes match.
+        # Don't bother with Tags if we're searching for text.
+        if isinstance(markup, Tag):
+            if self._searches_tags and self._tag_matches(markup):
+                found = markup
+        # If it's text, make sure the text matches.
+        elif isinstance(markup, str):
+            if self._searches_strings and self._text_matches(markup):
+                found = markup
         # If given a list of items, scan it for a text element that
         # matches.
-        if hasattr(markup, '__iter__') and not isinstance(markup, (Tag, str)):
+        elif hasattr(markup, '__iter__'):
             for element in markup:
                 if isinstance(element, NavigableString) \
                        and self.search(element):
                     found = element
                     break
-        # If it's a Tag, make sure its name or attributes match.
-        # Don't bother with Tags if we're searching for text.
-        elif isinstance(markup, Tag):
-            if not self.text or self.name or self.attrs:
-                found = self.search_tag(markup)
-        # If it's text, make sure the text matches.
-        elif isinstance(markup, NavigableString) or \
-                 isinstance(markup, str):
-            if not self.name and not self.attrs and self._matches(markup, self.text):
-                found = markup
         else:
             raise Exception(
                 "I don't know how to match against a %s" % markup.__class__)
         return found
 
     def _matches(self, markup, match_against, already_tried=None):
-        # print u"Matching %s against %s" % (markup, match_against)
-        result = False
-        if isinstance(markup, list) or isinstance(markup, tuple):
-            # This should only happen when searching a multi-valued attribute
-            # like 'class'.
-            for item in markup:
-                if self._matches(item, match_against):
-                    return True
-            # We didn't match any particular value of the multivalue
-            # attribute, but maybe we match the attribute value when
-            # considered as a string.
-            if self._matches(' '.join(markup), match_against):
-                return True
-            return False
-        
-        if match_against is True:
-            # True matches any non-None value.
-            return markup is not None
-
-        if isinstance(match_against, collections.Callable):
-            return match_against(markup)
-
-        # Custom callables take the tag as an argument, but all
-        # other ways of matching match the tag name as a string.
-        original_markup = markup
-        if isinstance(markup, Tag):
-            markup = markup.name
-
-        # Ensure that `markup` is either a Unicode string, or None.
-        markup = self._normalize_search_value(markup)
-
-        if markup is None:
-            # None matches None, False, an empty string, an empty list, and so on.
-            return not match_against
-
-        if (hasattr(match_against, '__iter__')
-            and not isinstance(match_against, str)):
-            # We're asked to match against an iterable of items.
-            # The markup must be match at least one item in the
-            # iterable. We'll try each one in turn.
-            #
-            # To avoid infinite recursion we need to keep track of
-            # items we've already seen.
-            if not already_tried:
-                already_tried = set()
-            for item in match_against:
-                if item.__hash__:
-                    key = item
-                else:
-                    key = id(item)
-                if key in already_tried:
-                    continue
-                else:
-                    already_tried.add(key)
-                    if self._matches(original_markup, item, already_tried):
-                        return True
-            else:
-                return False
-        
-        # Beyond this point we might need to run the test twice: once against
-        # the tag's name and once against its prefixed name.
-        match = False
-        
-        if not match and isinstance(match_against, str):
-            # Exact string match
-            match = markup == match_against
-
-        if not match and hasattr(match_against, 'search'):
-            # Regexp match
-            return match_against.search(markup)
-
-        if (not match
-            and isinstance(original_markup, Tag)
-            and original_markup.prefix):
-            # Try the whole thing again with the prefixed tag name.
-            return self._matches(
-                original_markup.prefix + ':' + original_markup.name, match_against
-            )
-
-        return match
+        return self._matcher(match_against, already_tried)(markup)
 
 
 class ResultSet(list):
@@ -0,0 +1,426 @@
+"""A compact binary format for Beautiful Soup trees.
+
+A snapshot is a flat array of node records in document order, each of
+which refers to its parent by position, plus one table of every string
+in the tree. Loading a snapshot links the nodes back together without
+parsing any markup, so it's a much cheaper way than HTML to keep a tree
+on disk or hand it to another process, and much smaller than a pickle.
+
+    data = snapshot.dumps(soup)
+    soup = snapshot.loads(data)
+"""
+
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+__all__ = [
+    'SnapshotError',
+    'dumps',
+    'loads',
+    ]
+
+from array import array
+import struct
+import sys
+
+from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+from bs4.element import (
+    AttributeValueList,
+    CData,
+    CharsetMetaAttributeValue,
+    Comment,
+    ContentMetaAttributeValue,
+    Declaration,
+    Doctype,
+    HTMLAwareEntitySubstitution,
+    NamespacedAttribute,
+    NavigableString,
+    ProcessingInstruction,
+    Tag,
+    XMLProcessingInstruction,
+    )
+
+MAGIC = b'BS4S'
+
+# Bump this whenever the layout changes. loads() refuses snapshots
+# from any other version rather than guess at them.
+VERSION = 1
+
+# The magic number, the version, the flags, the number of strings, the
+# number of words of node records, and the size of the string data in
+# bytes. The string lengths, the node records and the string data
+# follow, in that order.
+_header = struct.Struct('<4sHHIII')
+
+# Flags in the header.
+_SOUP = 1
+_CONTAINS_REPLACEMENT_CHARACTERS = 2
+_IS_XML = 4
+_SHORT_WORDS = 8
+_STRUCTURAL_HASH = 16
+
+# The first word of every node record says what kind of node it is. A
+# tag's record is
+#   kind, parent, name, prefix, namespace, flags, number of attributes
+# followed by the attributes; a string's record is
+#   kind, parent, text
+# Strings are stored as their position in the string table plus one,
+# so that 0 can stand for None.
+_TAG = 0
+_string_classes = [
+    None, NavigableString, Comment, CData, ProcessingInstruction,
+    XMLProcessingInstruction, Declaration, Doctype]
+_string_kinds = dict(
+    (cls, kind) for (kind, cls) in enumerate(_string_classes) if kind)
+
+# Flags in a tag's record. Two bits hold .known_xml, which may be None.
+_CAN_BE_EMPTY_ELEMENT = 1
+_HIDDEN = 2
+_HAS_PARSER_CLASS = 4
+_KNOWN_XML_SHIFT = 3
+_known_xml_values = [None, False, True]
+
+# An attribute is
+#   key kind, name, prefix, namespace, value kind, value
+# where the value is a string, or a count followed by that many
+# strings for a list.
+_PLAIN_KEY = 0
+_NAMESPACED_KEY = 1
+
+_STRING_VALUE = 0
+_CHARSET_VALUE = 1
+_CONTENT_VALUE = 2
+_LIST_VALUE = 3
+_PLAIN_LIST_VALUE = 4
+_value_classes = [
+    None, CharsetMetaAttributeValue, ContentMetaAttributeValue]
+
+# The string lengths and the node records are unsigned 32-bit words,
+# stored little-endian, or 16-bit words if every number in the tree
+# fits in one, which is true of most documents.
+_WORD = 'I'
+_SHORT_WORD = 'H'
+_swap = sys.byteorder != 'little'
+
+
+class SnapshotError(ValueError):
+    """The data isn't a snapshot, or isn't one this version can read,
+    or the tree has something in it that can't be stored in one."""
+
+
+class _StringTable(object):
+    """The strings of a tree, each stored once."""
+
+    def __init__(self):
+        self.positions = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return 0
+        if not isinstance(value, str):
+            raise SnapshotError(
+                "Can't store %r in a snapshot: it isn't a string." % value)
+        position = self.positions.get(value)
+        if position is None:
+            self.strings.append(value)
+            position = self.positions[value] = len(self.strings)
+        return position
+
+
+def dumps(element):
+    """Turn a BeautifulSoup object, or a Tag and everything in it, into
+    a snapshot.
+
+    :return: A bytestring that loads() turns back into the same tree.
+    """
+    if not isinstance(element, Tag):
+        raise SnapshotError("Only a tag or a whole soup can be stored.")
+    strings = _StringTable()
+    string = strings.add
+    words = array(_WORD)
+    add = words.append
+
+    flags = 0
+    if isinstance(element, BeautifulSoup):
+        flags |= _SOUP
+        meta = element.__dict__
+        builder = meta.get('builder')
+        if meta.get('contains_replacement_characters'):
+            flags |= _CONTAINS_REPLACEMENT_CHARACTERS
+        if meta.get('is_xml'):
+            flags |= _IS_XML
+        if not element.hash_by_identity:
+            flags |= _STRUCTURAL_HASH
+        words.extend((
+            string(getattr(builder, 'NAME', None)),
+            string(meta.get('original_encoding')),
+            string(meta.get('declared_html_encoding'))))
+    else:
+        words.extend((0, 0, 0))
+
+    # The tree is walked by its .contents rather than .next_element,
+    # because that's what says where everything is even if the
+    # .next_element links of a modified tree have been left behind.
+    count = 0
+    stack = [(element, 0)]
+    pop = stack.pop
+    while stack:
+        node, parent = pop()
+        position = count
+        count += 1
+        if isinstance(node, Tag):
+            known_xml = _known_xml_values.index(node.known_xml)
+            tag_flags = known_xml << _KNOWN_XML_SHIFT
+            if node.can_be_empty_element:
+                tag_flags |= _CAN_BE_EMPTY_ELEMENT
+            if node.hidden:
+                tag_flags |= _HIDDEN
+            if node.parser_class is not None:
+                tag_flags |= _HAS_PARSER_CLASS
+            attrs = node.attrs
+            words.extend((
+                _TAG, parent, string(node.name), string(node.prefix),
+                string(node.namespace), tag_flags, len(attrs)))
+            for key, value in attrs.items():
+                if isinstance(key, NamespacedAttribute):
+                    words.extend((
+                        _NAMESPACED_KEY, string(key.name),
+                        string(key.prefix), string(key.namespace)))
+                else:
+                    words.extend((_PLAIN_KEY, string(key), 0, 0))
+                value_class = type(value)
+                if value_class is AttributeValueList:
+                    add(_LIST_VALUE)
+                elif value_class is list:
+                    add(_PLAIN_LIST_VALUE)
+                elif value_class in _value_classes:
+                    words.extend((
+                        _value_classes.index(value_class),
+                        string(value.original_value)))
+                    continue
+                else:
+                    words.extend((_STRING_VALUE, string(value)))
+                    continue
+                add(len(value))
+                for item in value:
+                    add(string(item))
+            stack.extend(
+                (child, position) for child in reversed(node.contents))
+        else:
+            kind = _string_kinds.get(type(node))
+            if kind is None:
+                raise SnapshotError(
+                    "Can't store a %s in a snapshot." % type(node).__name__)
+            words.extend((kind, parent, string(node)))
+
+    lengths = array(_WORD, [len(s) for s in strings.strings])
+    text = ''.join(strings.strings).encode('utf-8', 'surrogatepass')
+    if max(lengths, default=0) < 0x10000 and max(words) < 0x10000:
+        flags |= _SHORT_WORDS
+        lengths = array(_SHORT_WORD, lengths)
+        words = array(_SHORT_WORD, words)
+    if _swap:
+        lengths.byteswap()
+        words.byteswap()
+    header = _header.pack(
+        MAGIC, VERSION, flags, len(lengths), len(words), len(text))
+    return b''.join((header, lengths.tobytes(), words.tobytes(), text))
+
+
+def loads(data, builder=None):
+    """Rebuild a tree from a snapshot made by dumps().
+
+    :param builder: The TreeBuilder a rebuilt soup gets, as if it had
+        parsed the document. By default this is a new instance of the
+        builder that made the original soup, if it's installed, or
+        None if it isn't.
+    :return: A BeautifulSoup object, or a Tag with no parent, depending
+        on what was stored.
+    """
+    data = memoryview(data)
+    try:
+        (magic, version, flags, string_count, word_count,
+         text_size) = _header.unpack_from(data)
+    except struct.error:
+        raise SnapshotError("This is too short to be a snapshot.")
+    if magic != MAGIC:
+        raise SnapshotError("This isn't a Beautiful Soup snapshot.")
+    if version != VERSION:
+        raise SnapshotError(
+            "This is a version %d snapshot, but only version %d can be "
+            "read." % (version, VERSION))
+    if flags & _SHORT_WORDS:
+        typecode = _SHORT_WORD
+    else:
+        typecode = _WORD
+    lengths = array(typecode)
+    words = array(typecode)
+    start = _header.size
+    try:
+        end = start + string_count * lengths.itemsize
+        lengths.frombytes(data[start:end])
+        start, end = end, end + word_count * words.itemsize
+        words.frombytes(data[start:end])
+        start, end = end, end + text_size
+        if end != len(data):
+            raise SnapshotError("This snapshot is the wrong size.")
+        text = str(data[start:end], 'utf-8', 'surrogatepass')
+    except ValueError as e:
+        if isinstance(e, SnapshotError):
+            raise
+        raise SnapshotError("This snapshot is damaged: %s" % e)
+    if _swap:
+        lengths.byteswap()
+        words.byteswap()
+
+    # Slice the text back into strings. The string that stands for
+    # each position is shared by every node that uses it.
+    strings = [None]
+    append = strings.append
+    position = 0
+    for length in lengths:
+        end = position + length
+        append(text[position:end])
+        position = end
+
+    try:
+        return _build(flags, strings, words, builder)
+    except IndexError:
+        raise SnapshotError("This snapshot is damaged.")
+
+
+def _build(flags, strings, words, builder):
+    """Make the tree a snapshot describes."""
+    is_soup = flags & _SOUP
+    builder_name = strings[words[0]]
+    if is_soup:
+        if builder is None and builder_name is not None:
+            builder_class = builder_registry.lookup(builder_name)
+            if builder_class is not None:
+                builder = builder_class()
+    if builder is not None:
+        builder_whitespace_tags = builder.preserve_whitespace_tags
+    else:
+        builder_whitespace_tags = None
+    html_whitespace_tags = HTMLAwareEntitySubstitution.preserve_whitespace_tags
+
+    nodes = []
+    last = None
+    i = 3
+    end = len(words)
+    while i < end:
+        kind = words[i]
+        if nodes:
+            parent = nodes[words[i + 1]]
+        else:
+            parent = None
+        if kind == _TAG:
+            (name, prefix, namespace, tag_flags,
+             attr_count) = words[i + 2:i + 7]
+            i += 7
+            if parent is None and is_soup:
+                node = BeautifulSoup.__new__(BeautifulSoup)
+            else:
+                node = Tag.__new__(Tag)
+            if tag_flags & _HAS_PARSER_CLASS:
+                node.parser_class = BeautifulSoup
+            else:
+                node.parser_class = None
+            node._name = strings[name]
+            node.prefix = strings[prefix]
+            node.namespace = strings[namespace]
+            known_xml = _known_xml_values[tag_flags >> _KNOWN_XML_SHIFT]
+            node.known_xml = known_xml
+            if builder_whitespace_tags is not None:
+                node.preserve_whitespace_tags = builder_whitespace_tags
+            elif known_xml:
+                node.preserve_whitespace_tags = []
+            else:
+                node.preserve_whitespace_tags = html_whitespace_tags
+            attrs = {}
+            for _ in range(attr_count):
+                (key_kind, key_name, key_prefix, key_namespace,
+                 value_kind, value) = words[i:i + 6]
+                i += 6
+                if key_kind == _NAMESPACED_KEY:
+                    key = NamespacedAttribute(
+                        strings[key_prefix], strings[key_name],
+                        strings[key_namespace])
+                else:
+                    key = strings[key_name]
+                if value_kind == _STRING_VALUE:
+                    value = strings[value]
+                elif value_kind < _LIST_VALUE:
+                    value = _value_classes[value_kind](strings[value])
+                else:
+                    items = [strings[item] for item in words[i:i + value]]
+                    i += value
+                    if value_kind == _LIST_VALUE:
+                        value = AttributeValueList(items)
+                    else:
+                        value = items
+                attrs[key] = value
+            node.attrs = attrs
+            node.contents = []
+            node.hidden = bool(tag_flags & _HIDDEN)
+            node.can_be_empty_element = bool(
+                tag_flags & _CAN_BE_EMPTY_ELEMENT)
+        else:
+            node = str.__new__(_string_classes[kind], strings[words[i + 2]])
+            i += 3
+
+        node.parent = parent
+        node.next_element = None
+        node.next_sibling = None
+        if parent is None:
+            node.previous_element = None
+            node.previous_sibling = None
+            node._position_hint = None
+        else:
+            # A parsed soup's own .next_element is None, so the first
+            # thing in a soup has no .previous_element either.
+            if last is not None and not (is_soup and last is nodes[0]):
+                last.next_element = node
+                node.previous_element = last
+            else:
+                node.previous_element = None
+            contents = parent.contents
+            if contents:
+                previous = contents[-1]
+                previous.next_sibling = node
+                node.previous_sibling = previous
+            else:
+                node.previous_sibling = None
+            node._position_hint = len(contents)
+            contents.append(node)
+        nodes.append(node)
+        last = node
+
+    if not nodes:
+        raise SnapshotError("This snapshot is empty.")
+    root = nodes[0]
+    if is_soup:
+        root.builder = builder
+        root.is_xml = bool(flags & _IS_XML)
+        root.hash_by_identity = not flags & _STRUCTURAL_HASH
+        root.parse_only = None
+        root.on_subtree = None
+        root.markup = None
+        root.original_encoding = strings[words[1]]
+        root.declared_html_encoding = strings[words[2]]
+        root.contains_replacement_characters = bool(
+            flags & _CONTAINS_REPLACEMENT_CHARACTERS)
+        root.name_index = None
+        root.mutation_version = 0
+        root.change_journal = None
+        root.current_data = []
+        root.currentTag = root
+        root.tagStack = [root]
+        root.preserve_whitespace_tag_stack = []
+        if last is not root:
+            root._most_recent_element = last
+        else:
+            root._most_recent_element = None
+    return root
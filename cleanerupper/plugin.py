@@ -1,22 +1,374 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
 import re
 import sys
 import bs4
+import bs4.snapshot
 import os
 
+# How many processes clean chapters at the same time. 1 cleans them one after
+# another in this process. Starting worker processes from inside Sigil's
+# embedded interpreter is not always safe, so the pool is opt-in: set a larger
+# number, or None for one per core, to use it.
+WORKERS = 1
+
+# Cleaned chapters are kept here, so that running the plugin again on a book
+# only cleans the chapters which have changed since. None turns it off.
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+CACHE_SIZE = 64 * 2 ** 20
+
+# Chapters are parsed with the fastest tree builder installed that gives the
+# same html as html.parser. Which one that is gets measured once and written
+# here, so later runs skip the benchmark. None measures it on every run.
+PARSER_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser.json')
+
 html_cleaners = []
 soup_cleaners = []
 global_footnotes = {}
+footnote_links = []
 
 def html_cleaner(function):
     html_cleaners.append(function)
 
+def html_rules(function):
+    '''
+    Register a function which yields (pattern, replacement) rules, as an html
+    cleaner which applies them in order as if by re.sub. A rule may have a
+    third item, a pattern which matches wherever the rule would change the
+    text, for rules whose own pattern also matches text that they leave alone.
+    '''
+    rules = TextRules(function())
+    html_cleaners.append(rules)
+    return rules
+
 def soup_cleaner(function):
     soup_cleaners.append(function)
 
+def tag_cleaner(*names):
+    '''
+    Register a function(soup, tag) which will be called for every tag with one
+    of these names, in document order. Use '*' for all tags. It runs as a soup
+    cleaner, so it sees the soup after every cleaner registered before it.
+    '''
+    def wrapper(function):
+        soup_cleaners.append(TagCleaner(function, names))
+        return function
+    return wrapper
+
+class IdentitySet:
+    '''
+    A set of elements which compares them by identity, in insertion order.
+    NavigableStrings are equal to any string with the same text, and Tags are
+    equal to any tag with the same structure, so a regular set would lump
+    distinct elements together.
+    '''
+    def __init__(self, elements=()):
+        self.elements = {}
+        for element in elements:
+            self.add(element)
+
+    def __contains__(self, element):
+        return id(element) in self.elements
+
+    def __iter__(self):
+        return iter(self.elements.values())
+
+    def __len__(self):
+        return len(self.elements)
+
+    def add(self, element):
+        self.elements[id(element)] = element
+
+    def discard(self, element):
+        self.elements.pop(id(element), None)
+
+# A literal character at the start of a pattern, which is not made optional or
+# repeated by a quantifier right after it.
+LEADING_LITERAL = re.compile(r'(\\[^0-9A-Za-z]|[^.^$*+?{}\[\]\\|()])(?![*+?{])')
+
+def split_alternatives(pattern):
+    '''
+    Split a pattern on the | characters which are not inside a group or a
+    character class.
+    '''
+    alternatives = []
+    depth = 0
+    in_class = False
+    start = 0
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            index += 1
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+            if pattern[index+1:index+2] == '^':
+                index += 1
+            # A ] right after the opening bracket is a literal.
+            if pattern[index+1:index+2] == ']':
+                index += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            alternatives.append(pattern[start:index])
+            start = index + 1
+        index += 1
+    alternatives.append(pattern[start:])
+    return alternatives
+
+def combine_patterns(patterns):
+    '''
+    Return one pattern which matches wherever any of these patterns would.
+    Alternatives which begin with the same literal characters are merged into
+    one branch, so the regex engine does not have to try each of them in turn
+    at every position of the text, and can skip ahead to the characters which
+    could start a match.
+    '''
+    branches = {}
+    opaque = []
+    for pattern in patterns:
+        for alternative in split_alternatives(pattern):
+            match = LEADING_LITERAL.match(alternative)
+            if match is None:
+                opaque.append('(?:%s)' % alternative)
+                continue
+            branches.setdefault(match.group(1), []).append(alternative[match.end():])
+
+    alternatives = []
+    for (literal, rests) in branches.items():
+        if '' in rests:
+            alternatives.append(literal)
+        elif len(rests) == 1:
+            alternatives.append(literal + rests[0])
+        else:
+            alternatives.append('%s(?:%s)' % (literal, combine_patterns(rests)))
+    return '|'.join(alternatives + opaque)
+
+class TextRules:
+    '''
+    A list of regex substitutions which gives the same result as calling
+    re.sub for each of them in order. The rules may also be other TextRules.
+    Every rule is compiled once, along with its trigger, a pattern which
+    matches wherever the rule would change the text.
+
+    The triggers of the rules from any one on are combined into one pattern,
+    so a single scan finds the next rule which has anything to do, and the
+    rules before it are skipped. Text which none of the rules would change
+    costs one scan instead of one per rule. That scan costs about as much as
+    running half of the rules, though, so once a few rules have applied, the
+    rest simply run in order.
+    Patterns must use named backreferences, since their numbered groups move
+    around in the combined pattern.
+    '''
+    # How many rules are found with a scan before the rest run in order.
+    scan_limit = 2
+
+    def __init__(self, rules, cache_size=256):
+        self.rules = []
+        self.triggers = []
+        for rule in rules:
+            if isinstance(rule, TextRules):
+                self.rules.extend(rule.rules)
+                self.triggers.extend(rule.triggers)
+                continue
+            (pattern, replacement) = rule[:2]
+            trigger = rule[2] if len(rule) > 2 else pattern
+            self.rules.append(
+                (re.compile(pattern), replacement, re.compile(trigger)))
+            self.triggers.append(trigger)
+        self.combined_trigger = functools.lru_cache(maxsize=cache_size)(
+            self._combined_trigger)
+
+    def _combined_trigger(self, start, stop):
+        '''
+        Return the compiled combined trigger of the rules from start to stop.
+        '''
+        return re.compile(combine_patterns(self.triggers[start:stop]))
+
+    def next_rule(self, html, start):
+        '''
+        Return the index of the first rule from start on whose trigger matches
+        somewhere in the html, or None.
+        '''
+        stop = len(self.rules)
+        position = 0
+        while start < stop:
+            match = self.combined_trigger(start, stop).search(html, position)
+            if match is None:
+                break
+            # One of the rules before stop matches here. Once we know which,
+            # only the rules before that one are worth looking for. Their
+            # matches may overlap this one, so the search goes on from the
+            # next position rather than from the end of this match.
+            position = match.start()
+            for index in range(start, stop):
+                if self.rules[index][2].match(html, position):
+                    stop = index
+                    break
+            position += 1
+        if stop == len(self.rules):
+            return None
+        return stop
+
+    def __call__(self, html):
+        index = self.next_rule(html, 0)
+        applied = 0
+        while index is not None:
+            (pattern, replacement, trigger) = self.rules[index]
+            html = pattern.sub(replacement, html)
+            applied += 1
+            if applied == self.scan_limit:
+                for (pattern, replacement, trigger) in self.rules[index + 1:]:
+                    html = pattern.sub(replacement, html)
+                break
+            index = self.next_rule(html, index + 1)
+        return html
+
+class PatternTable:
+    '''
+    A list of patterns, or a dict of patterns to values, which are tried
+    against a string in order with re.match. All of them are compiled into
+    one alternation, and the answer for each distinct string is remembered,
+    since books tend to use a few class names over and over.
+    '''
+    def __init__(self, patterns, cache_size=1024):
+        if not isinstance(patterns, dict):
+            patterns = {pattern: True for pattern in patterns}
+        self.values = list(patterns.values())
+        alternation = '|'.join(
+            '(?P<p%d>%s)' % (index, pattern)
+            for (index, pattern) in enumerate(patterns)
+        )
+        self.pattern = re.compile(alternation)
+        self.match = functools.lru_cache(maxsize=cache_size)(self._match)
+
+    def _match(self, string):
+        '''
+        Return the value of the first pattern which matches the start of the
+        string, or None.
+        '''
+        match = self.pattern.match(string)
+        if match is None:
+            return None
+        return self.values[int(match.lastgroup[1:])]
+
+def compile_html_cleaners(cleaners):
+    '''
+    Return a list of functions which applies these html cleaners in order,
+    where each run of neighboring TextRules has been merged into one, so that
+    a chapter which is already clean is scanned once for all of them.
+    '''
+    compiled = []
+    run = []
+    for cleaner in cleaners + [None]:
+        if isinstance(cleaner, TextRules):
+            run.append(cleaner)
+            continue
+        if len(run) == 1:
+            compiled.extend(run)
+        elif run:
+            compiled.append(TextRules(run))
+        run = []
+        if cleaner is not None:
+            compiled.append(cleaner)
+    return compiled
+
+def is_decomposed(element):
+    # decompose() deletes every attribute of the elements it destroys, so a
+    # decomposed NavigableString has no parent at all, and reading the parent
+    # of a decomposed Tag searches its (empty) contents for a <parent> tag.
+    try:
+        object.__getattribute__(element, 'parent')
+    except AttributeError:
+        return True
+    return False
+
+def is_attached(element, root):
+    '''
+    Return True if the element is root or one of its descendants. Elements
+    which have been decomposed are never attached.
+    '''
+    while element is not None:
+        if element is root:
+            return True
+        if is_decomposed(element):
+            return False
+        element = element.parent
+    return False
+
+class TagCleaner:
+    '''
+    A soup cleaner which calls function(soup, tag) for each tag with one of
+    the names, or for every tag if one of the names is '*'.
+
+    The tags are the ones in the soup when it starts, or the soup's dirty_tags
+    on the later passes of clean_soup. Named tags come from the soup's name
+    index, a name at a time in the order the names were given; only '*' walks
+    the whole soup. They are listed before the function is called for any of
+    them, so tags which get moved are still visited exactly once, and tags
+    which get removed are skipped. Tags that it creates or renames are visited
+    on the next pass of clean_soup, which repeats until the soup stops
+    changing anyway.
+    '''
+    def __init__(self, function, names):
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.names = tuple(names)
+        self.every_tag = '*' in self.names
+
+    def find_tags(self, soup):
+        dirty = soup.dirty_tags
+        if self.every_tag:
+            if dirty is None:
+                dirty = soup.descendants
+            return [tag for tag in dirty if isinstance(tag, bs4.element.Tag)]
+        if dirty is None:
+            return [tag for name in self.names for tag in soup.find_all(name)]
+        return [tag for name in self.names for tag in dirty if tag.name == name]
+
+    def __call__(self, soup):
+        for tag in self.find_tags(soup):
+            if is_attached(tag, soup):
+                self.function(soup, tag)
+
+def dirty_tags(soup, journal):
+    '''
+    Return the tags which should be cleaned again after the changes in this
+    journal: every changed tag along with its children and its ancestors, and
+    every tag in the subtrees that were inserted. The cleaners only look at a
+    tag's own attributes, its parent, and its descendants, so nothing else can
+    have a different outcome than it did on the previous pass.
+    '''
+    tags = IdentitySet()
+    def add(tag):
+        if isinstance(tag, bs4.element.Tag) and tag is not soup:
+            tags.add(tag)
+
+    for (element, subtree) in journal:
+        if not is_attached(element, soup):
+            continue
+        for ancestor in reversed(list(element.parents)):
+            add(ancestor)
+        add(element)
+        if not isinstance(element, bs4.element.Tag):
+            continue
+        if subtree:
+            for descendant in element.descendants:
+                add(descendant)
+        else:
+            for child in element.children:
+                add(child)
+    return list(tags)
+
 def raise_children_and_delete(element):
-    children = list(element.children)
-    while children:
-        element.insert_after(children.pop(-1))
+    element.unwrap()
     element.decompose()
 
 def contains_class(element, cls):
@@ -25,7 +377,7 @@ def contains_class(element, cls):
     except (AttributeError, KeyError):
         return False
     if isinstance(element['class'], str):
-        element['class'] = element['class'].split()
+        element['class'] = bs4.element.AttributeValueList(element['class'].split())
 
     return cls in element['class']
 
@@ -33,100 +385,102 @@ def remove_class(element, cls):
     if not contains_class(element, cls):
         return
 
+    classes = bs4.element.AttributeValueList(element['class'])
     try:
-        element['class'].remove(cls)
+        classes.remove(cls)
     except IndexError:
         pass
-    if len(element['class']) == 0:
+    if len(classes) == 0:
         del element['class']
+    else:
+        element['class'] = classes
 
-@html_cleaner
-def remove_unwanted_stylesheets(html):
-    html = re.sub(r'<style type="text/css">\s*@page { margin-bottom: 5\.000000pt; margin-top: 5\.000000pt; }\s*</style>', '', html)
-    html = re.sub(r'style="margin-top: 0px; margin-left: 0px; margin-right: 0px; margin-bottom: 0px; text-align: center;"', '', html)
-    return html
+@html_rules
+def remove_unwanted_stylesheets():
+    yield (r'<style type="text/css">\s*@page { margin-bottom: 5\.000000pt; margin-top: 5\.000000pt; }\s*</style>', '')
+    yield (r'style="margin-top: 0px; margin-left: 0px; margin-right: 0px; margin-bottom: 0px; text-align: center;"', '')
 
-@html_cleaner
-def merge_neighboring_sametag(html):
+@html_rules
+def merge_neighboring_sametag():
     tags = ['i', 'b', 'em', 'strong', 'u', 'small']
     for tag in tags:
-        html = re.sub(r'</%s><%s>' % (tag, tag), '', html)
-        html = re.sub(r'</%s>\s*<%s>' % (tag, tag), ' ', html)
-        html = re.sub(r'</%s>\s*<br/?>\s*<%s>' % (tag, tag), '<br/>', html)
-
-    return html
+        yield (r'</%s><%s>' % (tag, tag), '')
+        yield (r'</%s>\s*<%s>' % (tag, tag), ' ')
+        yield (r'</%s>\s*<br/?>\s*<%s>' % (tag, tag), '<br/>')
 
-@html_cleaner
-def bring_punctuation_into_italics(html):
+@html_rules
+def bring_punctuation_into_italics():
     for tag in ['i', 'b', 'em', 'strong']:
         for punct in ['.', ',', '-', '—']:
-            html = re.sub('\\{punct}<{tag}>'.format(**locals()), '<{tag}>{punct}'.format(**locals()), html)
-            html = re.sub('</{tag}>\\{punct}'.format(**locals()), '{punct}</{tag}>'.format(**locals()), html)
-    return html
-
-@html_cleaner
-def remove_header_br(html):
-    html = re.sub(r'<h1>([^\n]+?)\s*<br/>\s*([^\n]+?)</h1>', r'<h1>\1 \2</h1>', html)
-    html = re.sub(r'<h2>([^\n]+?)\s*<br/>\s*([^\n]+?)</h2>', r'<h2>\1 \2</h2>', html)
-    html = re.sub(r'<h3>([^\n]+?)\s*<br/>\s*([^\n]+?)</h3>', r'<h3>\1 \2</h3>', html)
-    html = re.sub(r'<h4>([^\n]+?)\s*<br/>\s*([^\n]+?)</h4>', r'<h4>\1 \2</h4>', html)
-    html = re.sub(r'<h5>([^\n]+?)\s*<br/>\s*([^\n]+?)</h5>', r'<h5>\1 \2</h5>', html)
-    html = re.sub(r'<h6>([^\n]+?)\s*<br/>\s*([^\n]+?)</h6>', r'<h6>\1 \2</h6>', html)
-    return html
-
-@html_cleaner
-def remove_misc_strings(html):
-    html = html.replace('epub:type="pagebreak"', '')
-    html = html.replace('<!-- BodyStart-->', '')
-    html = html.replace('<!-- BodyEnd-->', '')
-    html = re.sub(r'title="[ivx]+"', '', html)
-    html = re.sub(r'title="\d+"', '', html)
-    return html
-
-@html_cleaner
-def remove_space_around_br(html):
-    html = re.sub(r'\s*<br/?>\s*', '<br/>', html)
-    return html
-
-@html_cleaner
-def replace_smart_quotes(html):
-    html = re.sub(r'”|“', '"', html)
-    html = re.sub(r'‘|’|ʹ|`', "'", html)
-    return html
+            yield ('\\{punct}<{tag}>'.format(**locals()), '<{tag}>{punct}'.format(**locals()))
+            yield ('</{tag}>\\{punct}'.format(**locals()), '{punct}</{tag}>'.format(**locals()))
+
+@html_rules
+def remove_header_br():
+    for level in range(1, 7):
+        yield (r'<h{level}>([^\n]+?)\s*<br/>\s*([^\n]+?)</h{level}>'.format(level=level), r'<h{level}>\1 \2</h{level}>'.format(level=level))
+
+@html_rules
+def remove_misc_strings():
+    yield (re.escape('epub:type="pagebreak"'), '')
+    yield (re.escape('<!-- BodyStart-->'), '')
+    yield (re.escape('<!-- BodyEnd-->'), '')
+    yield (r'title="[ivx]+"', '')
+    yield (r'title="\d+"', '')
+
+@html_rules
+def remove_space_around_br():
+    # Already tidy <br/> tags match the pattern too, so only whitespace or an
+    # unclosed <br> means there is something to do. The lookbehind keeps the
+    # trigger starting with a literal <.
+    yield (r'\s*<br/?>\s*', '<br/>', r'<(?<=\s<)br/?>|<br>|<br/?>\s')
+
+@html_rules
+def replace_smart_quotes():
+    yield (r'”|“', '"')
+    yield (r'‘|’|ʹ|`', "'")
+
+@html_rules
+def remove_empty_attributes():
+    yield (r'alt="\s*"', '')
+    yield (r'class="\s*"', '')
+    yield (r'id="\s*"', '')
+    yield (r'title="\s*"', '')
+
+@html_rules
+def remove_empty_elements():
+    yield (r'<(?P<tag>\w+)>(&(nbsp|emsp|ensp|thinsp|#160);|\s|<br/?>)*</(?P=tag)>', '')
+
+@tag_cleaner('blockquote')
+def collect_footnotes(soup, footnote):
+    if not contains_class(footnote, 'gcufootnote_content'):
+        return
+    try:
+        footnote_id = next(footnote.stripped_strings)
+    except StopIteration:
+        print(footnote, 'is malformed. No string contents.')
+        return
+    if not footnote_id.startswith('['):
+        print(footnote, 'is malformed. Should start with [id].')
+        return
+    footnote_id = footnote_id.split('[', 1)[-1].split(']', 1)[0]
 
-@html_cleaner
-def remove_empty_attributes(html):
-    html = re.sub(r'alt="\s*"', '', html)
-    html = re.sub(r'class="\s*"', '', html)
-    html = re.sub(r'id="\s*"', '', html)
-    html = re.sub(r'title="\s*"', '', html)
-    return html
+    global_footnotes[footnote_id] = footnote
 
-@html_cleaner
-def remove_empty_elements(html):
-    html = re.sub(r'(?s)<(\w+)>(&(nbsp|emsp|ensp|thinsp|#160);|\s|<br/?>)*</\1>', '', html)
-    return html
-
-@soup_cleaner
-def collect_footnotes(soup):
-    footnotes = soup.find_all('blockquote', {'class': 'gcufootnote_content'})
-    for footnote in footnotes:
-        try:
-            footnote_id = next(footnote.stripped_strings)
-        except StopIteration:
-            print(footnote, 'is malformed. No string contents.')
-            continue
-        if not footnote_id.startswith('['):
-            print(footnote, 'is malformed. Should start with [id].')
-            continue
-        footnote_id = footnote_id.split('[', 1)[-1].split(']', 1)[0]
-
-        global_footnotes[footnote_id] = footnote
+@tag_cleaner('span')
+def collect_footnote_links(soup, span):
+    if contains_class(span, 'gcufootnote_link'):
+        footnote_links.append(span)
 
 @soup_cleaner
 def inject_footnotes(soup):
-    footnote_links = soup.find_all('span', {'class': 'gcufootnote_link'})
-    for footnote_link in reversed(footnote_links):
+    # The links are gathered by collect_footnote_links, which runs after
+    # collect_footnotes, so every footnote in this soup has been collected.
+    links = list(footnote_links)
+    footnote_links.clear()
+    for footnote_link in reversed(links):
+        if not is_attached(footnote_link, soup):
+            continue
         if contains_class(footnote_link.parent, 'gcufootnote_content'):
             # In the case of nested footnotes, let's place the parent first
             # and come back for this child on the next go around.
@@ -161,224 +515,213 @@ def inject_footnotes(soup):
         footnote_link.decompose()
         remove_class(footnote, 'gcufootnote_content')
 
-@soup_cleaner
-def center_images(soup):
-    for img in soup.find_all('img'):
-        if img.parent.name == 'body':
-            center = soup.new_tag('center')
-            img.insert_before(center)
-            center.append(img)
-        elif img.parent.name in ['div', 'p'] and not img.parent.attrs:
-            img.parent.name = 'center'
-
-@soup_cleaner
-def convert_textdivs_p(soup):
-    divs = soup.find_all('div')
-    for div in divs:
-        children = list(div.children)
-        convertme = True
-        for child in children:
-            if isinstance(child, bs4.element.NavigableString):
-                pass
-            elif child.name in ['i', 'b', 'em', 'strong', 'a', 'span', 'small']:
-                pass
-            else:
-                convertme = False
-                break
-        if convertme:
-            div.name = 'p'
-
-@soup_cleaner
-def remove_body_br(soup):
-    for br in soup.find_all('br'):
-        if br.parent.name == 'body':
-            br.decompose()
-
-@soup_cleaner
-def remove_empty_paragraphs(soup):
-    brs = soup.find_all('br')
-    br_parents = set(br.parent for br in brs)
-    for br_parent in br_parents:
-        if all(child.name == 'br' for child in br_parent.contents):
-            br_parent.decompose()
-
-@soup_cleaner
-def remove_unwanted_classes_ids(soup):
-    PATTERNS = [
-        r'big\d+',
-        r'blnonindent\d*',
-        r'bodyMatter',
-        r'c\d+',
-        r'calibre_?\d*',
-        r'calibre_pb_\d+',
-        r'calibreclass\d*',
-        r'chapter',
-        r'div\d+',
-        r'dropcaps',
-        r'filepos\d*',
-        r'font',
-        r'hanging',
-        r'indent\d*',
-        r'initial\d*',
-        r'initialcaps',
-        r'large',
-        r'mbp_?pagebreak',
-        r'morespaceabove',
-        r'noindent\d*',
-        r'nonindent\d*',
-        r'p_?[ivx]+',
-        r'p_?\d+',
-        r'page_?[ivx]+',
-        r'page_?\d+',
-        r'page_top_padding',
-        r'pagebreak',
-        r'para',
-        r'pgepubid\d*',
-        r'right',
-        r'section',
-        r'space[Bb]reak',
-        r'spaceabove',
-        r'squeeze(\d+)?',
-        r'stickupcaps',
-        r'title',
-        r'xrefInternal',
-    ]
-    for tag in soup.descendants:
-        if not isinstance(tag, bs4.element.Tag):
-            continue
-
-        if tag.get('class'):
-            if isinstance(tag['class'], str):
-                tag['class'] = tag['class'].split()
-            else:
-                tag['class'] = list(tag['class'])
-
-            try:
-                tag['class'].remove('')
-            except ValueError:
-                pass
-
-            # Intentional list() duplicate so we can remove from original.
-            for cls in list(tag['class']):
-                if any(re.match(pattern, cls) for pattern in PATTERNS):
-                    tag['class'].remove(cls)
-
-            if len(tag['class']) == 0 or tag['class'][0] == '':
-                del tag['class']
-
-        if tag.get('id'):
-            if any(re.match(pattern, tag['id']) for pattern in PATTERNS):
-                del tag['id']
+@tag_cleaner('img')
+def center_images(soup, img):
+    if img.parent.name == 'body':
+        center = soup.new_tag('center')
+        img.insert_before(center)
+        center.append(img)
+    elif img.parent.name in ['div', 'p'] and not img.parent.attrs:
+        img.parent.name = 'center'
+
+@tag_cleaner('div')
+def convert_textdivs_p(soup, div):
+    children = list(div.children)
+    convertme = True
+    for child in children:
+        if isinstance(child, bs4.element.NavigableString):
+            pass
+        elif child.name in ['i', 'b', 'em', 'strong', 'a', 'span', 'small']:
+            pass
+        else:
+            convertme = False
+            break
+    if convertme:
+        div.name = 'p'
+
+@tag_cleaner('br')
+def remove_body_br(soup, br):
+    if br.parent.name == 'body':
+        br.decompose()
+
+@tag_cleaner('*')
+def remove_empty_paragraphs(soup, tag):
+    # The <br>s of the body itself are taken care of by remove_body_br.
+    if tag.name == 'body' or not tag.contents:
+        return
+    if all(child.name == 'br' for child in tag.contents):
+        tag.decompose()
+
+UNWANTED_CLASSES_IDS = PatternTable([
+    r'big\d+',
+    r'blnonindent\d*',
+    r'bodyMatter',
+    r'c\d+',
+    r'calibre_?\d*',
+    r'calibre_pb_\d+',
+    r'calibreclass\d*',
+    r'chapter',
+    r'div\d+',
+    r'dropcaps',
+    r'filepos\d*',
+    r'font',
+    r'hanging',
+    r'indent\d*',
+    r'initial\d*',
+    r'initialcaps',
+    r'large',
+    r'mbp_?pagebreak',
+    r'morespaceabove',
+    r'noindent\d*',
+    r'nonindent\d*',
+    r'p_?[ivx]+',
+    r'p_?\d+',
+    r'page_?[ivx]+',
+    r'page_?\d+',
+    r'page_top_padding',
+    r'pagebreak',
+    r'para',
+    r'pgepubid\d*',
+    r'right',
+    r'section',
+    r'space[Bb]reak',
+    r'spaceabove',
+    r'squeeze(\d+)?',
+    r'stickupcaps',
+    r'title',
+    r'xrefInternal',
+])
+
+@tag_cleaner('*')
+def remove_unwanted_classes_ids(soup, tag):
+    if tag.get('class'):
+        classes = tag['class']
+        if isinstance(classes, str):
+            classes = classes.split()
+
+        if all(cls and not UNWANTED_CLASSES_IDS.match(cls) for cls in classes):
+            keep = classes
+        else:
+            keep = bs4.element.AttributeValueList(
+                cls for cls in classes
+                if cls and not UNWANTED_CLASSES_IDS.match(cls)
+            )
+
+        # Only write the attribute when it actually changes, so that a clean
+        # tag doesn't count as a mutation of the soup.
+        if len(keep) == 0:
+            del tag['class']
+        elif keep is not tag['class']:
+            tag['class'] = keep
+
+    if tag.get('id'):
+        if UNWANTED_CLASSES_IDS.match(tag['id']):
+            del tag['id']
+
+@tag_cleaner('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+def remove_header_italic_bold(soup, header):
+    children = list(header.children)
+    if len(children) > 1:
+        return
+    if len(children) == 0:
+        header.extract()
+        return
+    child = children[0]
+    if isinstance(child, str):
+        return
+    if child.name in ['i', 'b', 'em', 'strong']:
+        raise_children_and_delete(child)
 
-@soup_cleaner
-def remove_header_italic_bold(soup):
-    headers = [h for tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6'] for h in soup.find_all(tag)]
-    for header in headers:
-        children = list(header.children)
-        if len(children) > 1:
-            continue
-        if len(children) == 0:
-            header.extract()
-            continue
-        child = children[0]
-        if isinstance(child, str):
-            continue
-        if child.name in ['i', 'b', 'em', 'strong']:
-            raise_children_and_delete(child)
+@tag_cleaner('div')
+def remove_useless_divs(soup, div):
+    if div.attrs:
+        return
+    if all(isinstance(child, bs4.element.Tag) or child.isspace() for child in div.contents):
+        raise_children_and_delete(div)
 
-@soup_cleaner
-def remove_useless_divs(soup):
-    divs = soup.find_all('div')
-    for div in divs:
-        if div.attrs:
-            continue
-        if all(isinstance(child, bs4.element.Tag) or child.isspace() for child in div.contents):
-            raise_children_and_delete(div)
+@tag_cleaner('blockquote')
+def remove_useless_blockquote(soup, block):
+    if block.attrs:
+        return
+    if all(child.name == 'blockquote' or (isinstance(child, bs4.element.NavigableString) and child.isspace()) for child in block.contents):
+        raise_children_and_delete(block)
 
-@soup_cleaner
-def remove_useless_blockquote(soup):
-    blocks = soup.find_all('blockquote')
-    for block in blocks:
-        if block.attrs:
-            continue
-        if all(child.name == 'blockquote' or (isinstance(child, bs4.element.NavigableString) and child.isspace()) for child in block.contents):
-            raise_children_and_delete(block)
+@tag_cleaner('span')
+def remove_useless_spans(soup, span):
+    if span.attrs:
+        return
+    raise_children_and_delete(span)
 
-@soup_cleaner
-def remove_useless_spans(soup):
-    spans = soup.find_all('span')
-    for span in spans:
-        if span.attrs:
-            continue
-        raise_children_and_delete(span)
+@tag_cleaner('a')
+def remove_useless_atags(soup, atag):
+    if atag.attrs:
+        return
+    raise_children_and_delete(atag)
+
+@tag_cleaner('link', 'meta')
+def remove_useless_meta(soup, tag):
+    USELESS = {
+        'link': [
+            ('type', 'application/vnd.adobe-page-template+xml'),
+        ],
+        'meta': [
+            ('http-equiv', 'Content-Type'),
+            ('name', 'Adept.expected.resource'),
+            ('name', 'Adept.resource'),
+        ],
+    }
+    for (attribute, value) in USELESS[tag.name]:
+        if tag.get(attribute) == value:
+            tag.extract()
+            return
+
+@tag_cleaner('b', 'i', 'em', 'strong')
+def remove_nested_italic(soup, element):
+    if element.parent.name == element.name:
+        raise_children_and_delete(element)
+
+@tag_cleaner('span')
+def replace_italic_bold_span(soup, span):
+    tags = {'italic': 'i', 'italics': 'i', 'bold': 'b'}
+    if not span.get('class'):
+        return
 
-@soup_cleaner
-def remove_useless_atags(soup):
-    atags = soup.find_all('a')
-    for atag in atags:
-        if atag.attrs:
-            continue
-        raise_children_and_delete(atag)
+    if isinstance(span['class'], str):
+        span['class'] = span['class'].split()
 
-@soup_cleaner
-def remove_useless_meta(soup):
-    selectors = [
-        'link[type="application/vnd.adobe-page-template+xml"]',
-        'meta[http-equiv="Content-Type"]',
-        'meta[name="Adept.expected.resource"]',
-        'meta[name="Adept.resource"]',
-    ]
-    for selector in selectors:
-        for item in soup.select(selector):
-            item.extract()
+    if not any(cls in tags for cls in span['class']):
+        return
 
-@soup_cleaner
-def remove_nested_italic(soup):
-    elements = [element for tag in ['b', 'i', 'em', 'strong'] for element in soup.find_all(tag)]
-    for element in elements:
-        if element.parent.name == element.name:
-            raise_children_and_delete(element)
+    if len(span['class']) == 1:
+        new_name = tags[span['class'][0]]
+        del span['class']
+        span.name = new_name
 
-@soup_cleaner
-def replace_italic_bold_span(soup):
-    tags = {'italic': 'i', 'italics': 'i', 'bold': 'b'}
-    spans = set(span for cls in tags for span in soup.find_all('span', {'class': cls}))
-    for span in spans:
-        if isinstance(span['class'], str):
-            span['class'] = span['class'].split()
-
-        if len(span['class']) == 1:
-            new_name = tags[span['class'][0]]
-            del span['class']
-            span.name = new_name
-
-        elif all(cls in tags for cls in span['class']):
-            b = soup.new_tag('b')
-            del span['class']
-            span.name = 'i'
-            span.insert_before(b)
-            b.insert(0, span)
+    elif all(cls in tags for cls in span['class']):
+        b = soup.new_tag('b')
+        del span['class']
+        span.name = 'i'
+        span.insert_before(b)
+        b.insert(0, span)
 
-@soup_cleaner
-def replace_classes_real_tags(soup):
-    CLASSTAGS = {
-    'div': {
+CLASSTAGS = {
+    'div': PatternTable({
         r'block\d*': 'blockquote',
         r'blockquote': 'blockquote',
         r'center\d*': 'center',
         r'ext': 'blockquote',
         r'extract': 'blockquote',
         r'p+': 'p',
-    },
-    'p': {
+    }),
+    'p': PatternTable({
         r'block\d*': 'blockquote',
         r'blockquote': 'blockquote',
         r'center\d*': 'center',
         r'h2-?[abcde]': 'h2',
         r'h2-\d+': 'h2',
         r'p+': 'p',
-    },
-    'span': {
+    }),
+    'span': PatternTable({
         r'b(old)?': 'b',
         r'i(talic)?': 'i',
         r'sc': 'small',
@@ -386,84 +729,358 @@ def replace_classes_real_tags(soup):
         r'small[Cc]aps\d*': 'small',
         r'strike': 'strike',
         r'under(line)?': 'u',
-    }
-    }
+    }),
+}
 
-    for tag in soup.descendants:
-        if not isinstance(tag, bs4.element.Tag):
-            continue
-
-        if tag.name not in CLASSTAGS:
-            continue
-
-        if not tag.get('class'):
-            continue
-
-        if isinstance(tag['class'], str):
-            tag['class'] = tag['class'].split()
-        else:
-            tag['class'] = list(tag['class'])
+@tag_cleaner('div', 'p', 'span')
+def replace_classes_real_tags(soup, tag):
+    if not tag.get('class'):
+        return
 
-        if len(tag['class']) != 1:
-            continue
+    classes = tag['class']
+    if isinstance(classes, str):
+        classes = classes.split()
 
-        for (selector, new_name) in CLASSTAGS[tag.name].items():
-            if re.match(selector, tag['class'][0]):
-                tag.name = new_name
-                del tag['class']
-                break
+    if len(classes) != 1:
+        return
 
-@soup_cleaner
-def strip_unecessary_whitespace(soup):
-    tags = ['p', 'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
-    elements = [element for tag in tags for element in soup.find_all(tag)]
-
-    for element in elements:
-        descendants = list(element.descendants)
-        while descendants and not isinstance(descendants[0], bs4.element.NavigableString):
-            if descendants[0].name == 'br':
-                descendants[0].decompose()
-            descendants.pop(0)
-        while descendants and not isinstance(descendants[-1], bs4.element.NavigableString):
-            if descendants[-1].name == 'br':
-                descendants[-1].decompose()
-            descendants.pop(-1)
-
-        if not descendants:
-            continue
+    new_name = CLASSTAGS[tag.name].match(classes[0])
+    if new_name is not None:
+        tag.name = new_name
+        del tag['class']
+
+@tag_cleaner('p', 'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+def strip_unecessary_whitespace(soup, element):
+    descendants = list(element.descendants)
+    while descendants and not isinstance(descendants[0], bs4.element.NavigableString):
+        if descendants[0].name == 'br':
+            descendants[0].decompose()
+        descendants.pop(0)
+    while descendants and not isinstance(descendants[-1], bs4.element.NavigableString):
+        if descendants[-1].name == 'br':
+            descendants[-1].decompose()
+        descendants.pop(-1)
+
+    if not descendants:
+        return
 
-        if len(descendants) == 1:
+    # Only replace the strings that actually change, so that a clean element
+    # doesn't count as a mutation of the soup.
+    if len(descendants) == 1:
+        if descendants[0] != descendants[0].strip():
             descendants[0].replace_with(descendants[0].strip())
-            continue
+        return
 
+    if descendants[0] != descendants[0].lstrip():
         descendants[0].replace_with(descendants[0].lstrip())
+    if descendants[-1] != descendants[-1].rstrip():
         descendants[-1].replace_with(descendants[-1].rstrip())
 
+def clean_soup(soup):
+    '''
+    Run the soup_cleaners over the soup, in the order they were registered,
+    until they stop changing it.
+
+    The first pass visits the whole soup. Each following pass only visits the
+    dirty_tags of the previous pass's change journal, which soup_cleaners can
+    find in soup.dirty_tags. It is None during the first pass.
+    '''
+    soup.dirty_tags = None
+    soup.start_name_index()
+    soup.start_change_journal()
+
+    while True:
+        for cleaner in soup_cleaners:
+            cleaner(soup)
+
+        journal = soup.pop_change_journal()
+        if not journal:
+            break
+        soup.dirty_tags = dirty_tags(soup, journal)
+
+    soup.stop_change_journal()
+    soup.stop_name_index()
+    del soup.dirty_tags
+
+compiled_html_cleaners = compile_html_cleaners(html_cleaners)
+
+# A chapter like the ones found in books, for telling the tree builders apart.
+PARSER_PROBE = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+  <title>Chapter One</title>
+  <link href="../Styles/stylesheet.css" rel="stylesheet" type="text/css"/>
+  <meta content="text/html; charset=utf-8" http-equiv="Content-Type"/>
+</head>
+<body class="calibre">
+<div class="chapter" id="ch1">
+  <h2 class="chapter-title"><span class="bold">Chapter One</span><br/>The Beginning</h2>
+''' + '''  <p class="indent">&#8220;It&#8217;s <i>nothing</i>,&#8221; she said&#160;&mdash; and <b>meant</b> it. <a href="#fn1" id="ref1"><sup>1</sup></a></p>
+  <p class="calibre1"><span class="italic">Fish &amp; chips</span>, then tea.</p>
+  <blockquote class="gcufootnote" id="fn1"><p>A note.</p></blockquote>
+  <p class="center"><img alt="" src="../Images/rule.png"/></p>
+  <!-- scene break -->
+  <p> </p>
+''' * 20 + '''</div>
+</body>
+</html>
+'''
+
+@functools.lru_cache(maxsize=None)
+def parser_name():
+    '''
+    Return the name of the tree builder to parse chapters with.
+    '''
+    builder = bs4.builder.builder_registry.fastest(
+        PARSER_PROBE, 'html.parser', cache_file=PARSER_CACHE)
+    return builder.NAME
+
+@functools.lru_cache(maxsize=None)
+def soup_factory():
+    '''
+    Return the SoupFactory that parses every chapter and footnote, so the
+    tree builder is only set up once per process.
+    '''
+    return bs4.SoupFactory(parser_name())
+
 def cleanup_page(html):
     previous_html = None
     while previous_html != html:
         previous_html = html
 
-        for cleaner in html_cleaners:
+        for cleaner in compiled_html_cleaners:
             html = cleaner(html)
 
-        soup = bs4.BeautifulSoup(html, 'html.parser')
+        soup = soup_factory().parse(html)
 
-        for cleaner in soup_cleaners:
-            cleaner(soup)
+        # Even when the soup cleaners change nothing, parsing and serializing
+        # can change the html, so the loop only stops on the same html.
+        clean_soup(soup)
 
         html = str(soup)
 
     return html
 
-def run_once(book):
+class ChapterCache:
+    '''
+    Cleaned html on disk, in one file per chapter named by the hash of the
+    input html and a fingerprint of the cleaners. Reading an entry touches
+    the file, and evict deletes the files which were used longest ago until
+    the rest fit in max_size bytes.
+    Any problem with the disk is treated as a miss, since the chapter can
+    always be cleaned again.
+    '''
+    def __init__(self, directory, max_size, fingerprint):
+        self.directory = directory
+        self.max_size = max_size
+        self.fingerprint = fingerprint
+
+    def path(self, html):
+        hasher = hashlib.sha256(self.fingerprint.encode('utf-8'))
+        hasher.update(html.encode('utf-8'))
+        return os.path.join(self.directory, hasher.hexdigest() + '.html')
+
+    def get(self, html):
+        path = self.path(html)
+        try:
+            with open(path, 'r', encoding='utf-8', newline='') as handle:
+                cleaned = handle.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return cleaned
+
+    def put(self, html, cleaned):
+        path = self.path(html)
+        temp = path + '.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, 'w', encoding='utf-8', newline='') as handle:
+                handle.write(cleaned)
+            os.replace(temp, path)
+        except OSError:
+            pass
+
+    def evict(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+            entries = [(entry.stat(), entry.path) for entry in entries]
+        except OSError:
+            return
+        entries.sort(key=lambda pair: pair[0].st_mtime)
+        total = sum(stat.st_size for (stat, path) in entries)
+        for (stat, path) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= stat.st_size
+
+def cleaner_fingerprint():
+    '''
+    Return a string which changes whenever the cleaning could give a different
+    result: the registered cleaners, this file, and the source of bs4.
+    '''
+    hasher = hashlib.sha256()
+    cleaners = html_cleaners + soup_cleaners
+    for cleaner in cleaners:
+        name = getattr(cleaner, '__qualname__', type(cleaner).__qualname__)
+        hasher.update(name.encode('utf-8'))
+    for rules in html_cleaners:
+        for trigger in getattr(rules, 'triggers', []):
+            hasher.update(trigger.encode('utf-8'))
+    with open(__file__, 'rb') as handle:
+        hasher.update(handle.read())
+    # The bundled bs4 has changes of its own which don't bump its version.
+    package = os.path.dirname(os.path.abspath(bs4.__file__))
+    for (directory, subdirectories, files) in os.walk(package):
+        subdirectories.sort()
+        for name in sorted(files):
+            if not name.endswith('.py'):
+                continue
+            path = os.path.join(directory, name)
+            hasher.update(os.path.relpath(path, package).encode('utf-8'))
+            with open(path, 'rb') as handle:
+                hasher.update(handle.read())
+    return hasher.hexdigest()
+
+def open_cache():
+    if CACHE_DIRECTORY is None:
+        return None
+    return ChapterCache(CACHE_DIRECTORY, CACHE_SIZE, cleaner_fingerprint())
+
+def uses_footnotes(html):
+    # Chapters with footnotes depend on, and add to, global_footnotes, so they
+    # are always cleaned for real.
+    return 'gcufootnote' in html
+
+def cache_get(cache, html):
+    if cache is None or uses_footnotes(html):
+        return None
+    return cache.get(html)
+
+def cache_put(cache, html, cleaned):
+    if cache is None or uses_footnotes(html):
+        return
+    # The cleaned html is not stored as its own result. That only holds if
+    # cleaning it again really changes nothing, and the next run finds out by
+    # cleaning it, after which it is cached like any other chapter.
+    cache.put(html, cleaned)
+
+def clean_chapter(html, footnotes):
+    '''
+    Clean one chapter in a worker process, where global_footnotes does not
+    survive from one chapter to the next. The footnotes that are known so far
+    come in as {id: snapshot}, and this returns the cleaned html, the
+    footnotes that were collected from this chapter as {id: snapshot}, and
+    anything that was printed along the way.
+    '''
+    global_footnotes.clear()
+    for (footnote_id, footnote) in footnotes.items():
+        global_footnotes[footnote_id] = bs4.snapshot.loads(footnote)
+    known = dict(global_footnotes)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        html = cleanup_page(html)
+
+    collected = {
+        footnote_id: bs4.snapshot.dumps(footnote)
+        for (footnote_id, footnote) in global_footnotes.items()
+        if known.get(footnote_id) is not footnote
+    }
+    global_footnotes.clear()
+    return (html, collected, output.getvalue())
+
+def chapter_ids(book):
     for (id, href) in book.text_iter():
         if id in ('navid', 'nav.xhtml', 'nav.html'):
             continue
+        yield id
+
+def clean_chapters(book, ids, cache):
+    '''
+    Yield (id, html, cleaned html) for each chapter, in manifest order.
+    '''
+    for id in ids:
         print('Cleaning', id)
         html = book.readfile(id)
-        html = cleanup_page(html)
-        book.writefile(id, html)
+        cleaned = cache_get(cache, html)
+        if cleaned is not None:
+            yield (id, html, cleaned)
+            continue
+        cleaned = cleanup_page(html)
+        cache_put(cache, html, cleaned)
+        yield (id, html, cleaned)
+
+def clean_chapters_parallel(book, ids, cache, workers):
+    '''
+    Like clean_chapters, but the chapters which are not in the cache are
+    cleaned in a pool of worker processes, while this process does all of the
+    reading and writing in manifest order.
+    Each worker only knows the footnotes that were collected before this pass
+    began, so a link to a footnote from an earlier chapter is resolved on the
+    second pass, along with the links to later chapters.
+    Footnotes go back and forth as bs4 snapshots, which the other side loads
+    much faster than it could parse their html.
+    '''
+    footnotes = {
+        footnote_id: bs4.snapshot.dumps(footnote)
+        for (footnote_id, footnote) in global_footnotes.items()
+    }
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        jobs = []
+        for id in ids:
+            html = book.readfile(id)
+            cleaned = cache_get(cache, html)
+            if cleaned is None:
+                job = pool.submit(clean_chapter, html, footnotes)
+            else:
+                job = None
+            jobs.append((id, html, cleaned, job))
+
+        for (id, html, cleaned, job) in jobs:
+            print('Cleaning', id)
+            if job is None:
+                yield (id, html, cleaned)
+                continue
+            (cleaned, collected, output) = job.result()
+            sys.stdout.write(output)
+            for (footnote_id, footnote) in collected.items():
+                global_footnotes[footnote_id] = bs4.snapshot.loads(footnote)
+            cache_put(cache, html, cleaned)
+            yield (id, html, cleaned)
+
+def run_once(book, workers=None):
+    if workers is None:
+        workers = WORKERS or os.cpu_count() or 1
+
+    cache = open_cache()
+    ids = list(chapter_ids(book))
+    # Pick the parser before any workers start, so they don't all measure.
+    soup_factory()
+    if workers > 1 and len(ids) > 1:
+        chapters = clean_chapters_parallel(book, ids, cache, min(workers, len(ids)))
+    else:
+        chapters = clean_chapters(book, ids, cache)
+
+    # Writing a chapter makes Sigil treat it as modified, so the chapters
+    # which came out exactly as they went in are left alone.
+    changed = 0
+    for (id, html, cleaned) in chapters:
+        if cleaned == html:
+            continue
+        book.writefile(id, cleaned)
+        changed += 1
+
+    if cache is not None:
+        cache.evict()
+
+    print('Changed', changed, 'of', len(ids), 'chapters.')
+    return changed
 
 def run(book):
     run_once(book)
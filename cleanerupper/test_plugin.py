@@ -0,0 +1,68 @@
+import contextlib
+import io
+import unittest
+
+import bs4
+
+import plugin
+
+def clean_body(body):
+    plugin.global_footnotes.clear()
+    html = plugin.cleanup_page('<html><body>%s</body></html>' % body)
+    return html[len('<html><body>'):-len('</body></html>')]
+
+class CleanerOrderTest(unittest.TestCase):
+    '''
+    Each cleaner sees the soup after the cleaners registered before it have
+    finished with all of it.
+    '''
+    def test_image_is_centered_before_its_div_is_unwrapped(self):
+        self.assertEqual(
+            clean_body('<blockquote><div><img src="a.png"/></div></blockquote>'),
+            '<blockquote><center><img src="a.png"/></center></blockquote>')
+        self.assertEqual(
+            clean_body('<i><div><img src="a.png"/></div></i>'),
+            '<i><center><img src="a.png"/></center></i>')
+
+    def test_br_only_span_is_removed_before_whitespace_is_stripped(self):
+        self.assertEqual(
+            clean_body('<p><em><span id="keep"><br/></span>x</em></p>'),
+            '<p><em>x</em></p>')
+
+class DirtyTagsTest(unittest.TestCase):
+    def test_decomposed_string_is_not_attached(self):
+        soup = bs4.BeautifulSoup('<p><span>a</span></p>', 'html.parser')
+        soup.start_change_journal()
+        string = soup.new_string('b')
+        soup.span.append(string)
+        p = soup.p
+        soup.span.decompose()
+        journal = soup.pop_change_journal()
+        self.assertFalse(plugin.is_attached(string, soup))
+        self.assertEqual(plugin.dirty_tags(soup, journal), [p])
+
+    def test_nested_footnote_links(self):
+        # The inner link's text is moved into the outer link, which is then
+        # decomposed along with it.
+        with contextlib.redirect_stdout(io.StringIO()):
+            cleaned = clean_body(
+                '<p>x<span class="gcufootnote_link">[1]<span class="gcufootnote_link">[2]</span></span></p>'
+                '<blockquote class="gcufootnote_content"><p>[1] n</p></blockquote>'
+                '<blockquote class="gcufootnote_content"><p>[2] m</p></blockquote>'
+            )
+        self.assertEqual(
+            cleaned,
+            '<p>x[1]</p><blockquote><p>[1] n</p></blockquote><blockquote><p>[2] m</p></blockquote>')
+
+class FixpointTest(unittest.TestCase):
+    def test_cleaned_html_is_clean(self):
+        html = (
+            '<html><head>\n<meta http-equiv="Content-Type" content="text/html"/>\n'
+            '<title>T</title>\n</head><body>\n<div>\n<p>x</p>\n</div>\n</body></html>'
+        )
+        cleaned = plugin.cleanup_page(html)
+        self.assertEqual(cleaned, '<html><head>\n<title>T</title>\n</head><body>\n<p>x</p>\n</body></html>')
+        self.assertEqual(plugin.cleanup_page(cleaned), cleaned)
+
+if __name__ == '__main__':
+    unittest.main()